@@ -1,15 +1,21 @@
-from PyQt5.QtWidgets import QApplication, QMainWindow, QPushButton, QWidget
+from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import QTimer
-from itertools import product
-from threading import Thread
+from itertools import product, permutations
+from threading import Thread, Lock, Event
+from queue import Queue, Empty
 from timeit import timeit
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import sqlite3
+import hashlib
 import random
 import copy
 import sys
 import os
 import datetime
+import time
+import uuid
 
 hardcore = [[8, 0, 0, 0, 0, 0, 0, 0, 0],
             [0, 0, 3, 6, 0, 0, 0, 0, 0],
@@ -36,7 +42,112 @@ LEVELS_SETTINGS = {
 
 DB_NAME = 'sudoku.sqlite3'
 
+LEVEL_NAMES = {
+    "Легко 👶": 'EASY',
+    "Средне 👦": 'STANDARD',
+    "Сложно 🤓": 'HARD'
+}
+
+BANK_LOW_WATERMARK = 3
+BANK_HIGH_WATERMARK = 10
+BANK_ISOMORPHS_COUNT = 2
+BANK_GAME_JOBS_COUNT = 1
+BANK_CHECK_INTERVAL = 10 * PROGRAM_SECOND
+# Слоты флагов отмены: одновременных заданий пула генерации намного меньше
+GENERATION_CANCEL_SLOTS = 256
+
 ATTEMPTS_MAX_COUNT = 10000
+# Как часто удаление клеток сообщает о ходе работы, в попытках
+CARVE_PROGRESS_ATTEMPTS = 50
+
+ISOMORPH_MIX_COUNT = 100
+
+CANONICAL_MAX_SIZE = 3
+
+_GEOMETRY_CACHE = {}
+_LINKS_CACHE = {}
+_COLUMN_PERMUTATIONS_CACHE = {}
+_CONNECTIONS = {}
+_CONNECTIONS_LOCK = Lock()
+_WRITERS = {}
+# Флаги отмены заданий; задаются в процессах пула генерации
+_CANCEL_FLAGS = None
+
+# Сводная таблица рекордов; ее ведут триггеры на records
+LEADERS_SCHEMA_SCRIPT = """CREATE TABLE leaders (
+    user_id   INTEGER     REFERENCES users (id)
+                          NOT NULL,
+    level     STRING (20) NOT NULL,
+    best_time INTEGER,
+    attempts  INTEGER     NOT NULL,
+    rank      INTEGER     NOT NULL,
+    PRIMARY KEY (user_id, level)
+);
+CREATE INDEX leaders_level_time ON leaders (level, best_time);
+CREATE TRIGGER records_leaders_insert AFTER INSERT ON records
+BEGIN
+    INSERT OR IGNORE INTO leaders (user_id, level, best_time, attempts, rank)
+        SELECT NEW.user_id, level, NULL, 0, 1 FROM matrixes WHERE id = NEW.matrix_id;
+    UPDATE leaders SET rank = rank + 1
+        WHERE level = (SELECT level FROM matrixes WHERE id = NEW.matrix_id)
+          AND user_id != NEW.user_id
+          AND best_time > NEW.time
+          AND best_time <= COALESCE((SELECT best_time FROM leaders AS own
+                                     WHERE own.user_id = NEW.user_id
+                                       AND own.level = leaders.level), best_time);
+    UPDATE leaders SET attempts = attempts + 1,
+                       best_time = MIN(COALESCE(best_time, NEW.time), NEW.time)
+        WHERE user_id = NEW.user_id
+          AND level = (SELECT level FROM matrixes WHERE id = NEW.matrix_id);
+    UPDATE leaders SET rank = 1 + (SELECT COUNT(*) FROM leaders AS better
+                                   WHERE better.level = leaders.level
+                                     AND better.best_time < leaders.best_time)
+        WHERE user_id = NEW.user_id
+          AND level = (SELECT level FROM matrixes WHERE id = NEW.matrix_id);
+END;
+CREATE TRIGGER records_leaders_delete AFTER DELETE ON records
+BEGIN
+    UPDATE leaders SET attempts = attempts - 1,
+                       best_time = (SELECT MIN(records.time) FROM records
+                                    JOIN matrixes ON matrixes.id = records.matrix_id
+                                    WHERE records.user_id = leaders.user_id
+                                      AND matrixes.level = leaders.level)
+        WHERE user_id = OLD.user_id
+          AND level = (SELECT level FROM matrixes WHERE id = OLD.matrix_id);
+    DELETE FROM leaders WHERE attempts = 0;
+    UPDATE leaders SET rank = 1 + (SELECT COUNT(*) FROM leaders AS better
+                                   WHERE better.level = leaders.level
+                                     AND better.best_time < leaders.best_time)
+        WHERE level = (SELECT level FROM matrixes WHERE id = OLD.matrix_id);
+END;
+"""
+
+# Незаконченные игры и журнал их ходов
+GAMES_SCHEMA_SCRIPT = """CREATE TABLE games (
+    id             STRING (32) PRIMARY KEY
+                               NOT NULL,
+    matrix_id      INTEGER     REFERENCES matrixes (id),
+    size           INTEGER     NOT NULL,
+    level          STRING (20) NOT NULL,
+    timestamp      INTEGER     NOT NULL,
+    solved_matrix  BLOB        NOT NULL,
+    problem_matrix BLOB        NOT NULL,
+    board          BLOB        NOT NULL,
+    game_seconds   INTEGER     NOT NULL,
+    status         STRING (20) NOT NULL,
+    updated        INTEGER     NOT NULL
+);
+CREATE INDEX games_status ON games (status, size, updated);
+CREATE TABLE moves (
+    id      INTEGER     PRIMARY KEY AUTOINCREMENT
+                        NOT NULL,
+    game_id STRING (32) REFERENCES games (id)
+                        NOT NULL,
+    cell    INTEGER     NOT NULL,
+    value   INTEGER     NOT NULL
+);
+CREATE INDEX moves_game ON moves (game_id, id);
+"""
 
 CREATE_DATABASE_SCRIPT = """CREATE TABLE matrixes (
     id             INTEGER       PRIMARY KEY AUTOINCREMENT
@@ -45,10 +156,15 @@ CREATE_DATABASE_SCRIPT = """CREATE TABLE matrixes (
     size           INTEGER       NOT NULL,
     level          INTEGER       NOT NULL,
     timestamp      INTEGER       NOT NULL,
-    solved_matrix  STRING (2000) NOT NULL,
-    problem_matrix STRING (2000) NOT NULL,
-    status STRING (100) NOT NULL
+    solved_matrix  BLOB          NOT NULL,
+    problem_matrix BLOB          NOT NULL,
+    status STRING (100) NOT NULL,
+    canonical_hash STRING (32),
+    isomorph       INTEGER       NOT NULL
+                                 DEFAULT 0
 );
+CREATE UNIQUE INDEX matrixes_canonical_hash ON matrixes (canonical_hash) WHERE isomorph = 0;
+CREATE INDEX matrixes_bank ON matrixes (size, level, status);
 CREATE TABLE records (
     id        INTEGER     PRIMARY KEY AUTOINCREMENT
                           UNIQUE
@@ -60,45 +176,150 @@ CREATE TABLE records (
     time      INTEGER     NOT NULL,
     date      STRING (20) NOT NULL
 );
+CREATE INDEX records_matrix_time ON records (matrix_id, time);
+CREATE INDEX matrixes_level ON matrixes (level);
 CREATE TABLE users (
     id   INTEGER PRIMARY KEY AUTOINCREMENT
                  UNIQUE
                  NOT NULL,
     name STRING  NOT NULL
 );
+""" + LEADERS_SCHEMA_SCRIPT + GAMES_SCHEMA_SCRIPT
+
+DB_SCHEMA_VERSION = 7
+
+# Скрипты обновления базы, созданной предыдущей версией схемы;
+# обновления, которые нельзя выразить в SQL, лежат в MIGRATION_FUNCTIONS
+MIGRATION_SCRIPTS = {
+    1: """ALTER TABLE matrixes ADD COLUMN canonical_hash STRING (32);
+CREATE UNIQUE INDEX matrixes_canonical_hash ON matrixes (canonical_hash);
+""",
+    2: """ALTER TABLE matrixes ADD COLUMN isomorph INTEGER NOT NULL DEFAULT 0;
+DROP INDEX matrixes_canonical_hash;
+CREATE UNIQUE INDEX matrixes_canonical_hash ON matrixes (canonical_hash) WHERE isomorph = 0;
+""",
+    4: """CREATE INDEX matrixes_bank ON matrixes (size, level, status);
+""",
+    5: """CREATE INDEX records_matrix_time ON records (matrix_id, time);
+CREATE INDEX matrixes_level ON matrixes (level);
+""",
+    6: LEADERS_SCHEMA_SCRIPT + """INSERT INTO leaders (user_id, level, best_time, attempts, rank)
+    SELECT records.user_id, matrixes.level, MIN(records.time), COUNT(*), 1
+    FROM records
+    JOIN matrixes ON matrixes.id = records.matrix_id
+    GROUP BY records.user_id, matrixes.level;
+UPDATE leaders SET rank = 1 + (SELECT COUNT(*) FROM leaders AS better
+                               WHERE better.level = leaders.level
+                                 AND better.best_time < leaders.best_time);
+""",
+    7: GAMES_SCHEMA_SCRIPT
+}
 
-"""
+INSERT_SUDOKU_QUERY = """INSERT OR IGNORE INTO matrixes
+    (size, level, timestamp, solved_matrix, problem_matrix, status, canonical_hash, isomorph)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
+
+# Забирает один заготовленный судоку и помечает его занятым в том же запросе;
+# подзапрос целиком отвечает индекс matrixes_bank
+CLAIM_SUDOKU_QUERY = """UPDATE matrixes SET status = 'IN_USE'
+    WHERE id = (SELECT id FROM matrixes
+                WHERE size = ? AND level = ? AND status = 'PRELOADED'
+                LIMIT 1)
+    RETURNING id, timestamp, solved_matrix, problem_matrix"""
+
+LEADERS_PAGE_SIZE = 100
+
+# Рекорды по уровням читаются из сводной таблицы leaders, которую ведут триггеры
+LEADERS_QUERY = """SELECT leaders.rank, users.name, leaders.level, leaders.best_time, leaders.attempts
+    FROM leaders
+    JOIN users ON users.id = leaders.user_id
+    ORDER BY leaders.level, leaders.best_time
+    LIMIT ? OFFSET ?"""
+
+LEADERS_BY_LEVEL_QUERY = """SELECT leaders.rank, users.name, leaders.level, leaders.best_time,
+           leaders.attempts
+    FROM leaders
+    JOIN users ON users.id = leaders.user_id
+    WHERE leaders.level = ?
+    ORDER BY leaders.best_time
+    LIMIT ? OFFSET ?"""
+
+LEADERS_BY_MATRIX_QUERY = """SELECT RANK() OVER (ORDER BY records.time) AS place,
+           users.name, matrixes.level, records.time, records.date
+    FROM records
+    JOIN matrixes ON matrixes.id = records.matrix_id
+    JOIN users ON users.id = records.user_id
+    WHERE records.matrix_id = ?
+    ORDER BY place
+    LIMIT ? OFFSET ?"""
+
+INSERT_USER_QUERY = """INSERT INTO users (name)
+    SELECT ? WHERE NOT EXISTS (SELECT 1 FROM users WHERE name = ?)"""
+
+INSERT_RECORD_QUERY = """INSERT INTO records (user_id, matrix_id, time, date)
+    VALUES ((SELECT MIN(id) FROM users WHERE name = ?), ?, ?, ?)"""
+
+# Незаконченная игра хранится снимком доски board и журналом ходов moves после него;
+# журнал сворачивается в снимок каждые GAME_COMPACT_MOVES ходов
+INSERT_GAME_QUERY = """INSERT INTO games
+    (id, matrix_id, size, level, timestamp, solved_matrix, problem_matrix, board, game_seconds,
+     status, updated)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'IN_GAME', ?)"""
+
+INSERT_MOVE_QUERY = """INSERT INTO moves (game_id, cell, value) VALUES (?, ?, ?)"""
+
+UPDATE_GAME_TIME_QUERY = """UPDATE games SET game_seconds = ?, updated = ? WHERE id = ?"""
+
+COMPACT_GAME_QUERY = """UPDATE games SET board = ?, game_seconds = ?, updated = ? WHERE id = ?"""
+
+DELETE_MOVES_QUERY = """DELETE FROM moves WHERE game_id = ?"""
+
+LAST_GAME_QUERY = """SELECT id, matrix_id, level, timestamp, solved_matrix, problem_matrix,
+           board, game_seconds
+    FROM games
+    WHERE status = 'IN_GAME' AND size = ? AND id IS NOT ?
+    ORDER BY updated DESC
+    LIMIT 1"""
+
+GAME_MOVES_QUERY = """SELECT cell, value FROM moves WHERE game_id = ? ORDER BY id"""
+
+BOARD_MIN_CELL_SIZE = 24
+
+# Сколько секунд генерируется новая игра, после этого берется лучший найденный судоку
+GAME_GENERATION_TIMEOUT = 5
+
+GAME_AUTOSAVE_DELAY = 2 * PROGRAM_SECOND
+GAME_COMPACT_MOVES = 50
+
+# Поток записи объединяет задания в одну транзакцию за DB_WRITER_INTERVAL секунд
+# или по DB_WRITER_BATCH_SIZE заданий
+DB_WRITER_INTERVAL = 0.2
+DB_WRITER_BATCH_SIZE = 100
+DB_WRITER_CLOSE_TIMEOUT = 3
+
+MATRIX_FORMAT_VERSION = 1
+
+# Распаковка байта в две клетки по 4 бита
+_NIBBLES = [(byte >> 4, byte & 15) for byte in range(256)]
 
 
 def solve_sudoku(size, grid):
-    """Интерпретация алгоритма X для решения судоку"""
-    grid = copy.deepcopy(grid)
-    rows_count, colums_count = size
-    cells_count = rows_count * colums_count
-    x_set = ([("rc", rc) for rc in product(range(cells_count), range(cells_count))] +
-             [("rn", rn) for rn in product(range(cells_count), range(1, cells_count + 1))] +
-             [("cn", cn) for cn in product(range(cells_count), range(1, cells_count + 1))] +
-             [("bn", bn) for bn in product(range(cells_count), range(1, cells_count + 1))])
-    y_set = dict()
-    for r, c, n in product(range(cells_count), range(cells_count), range(1, cells_count + 1)):
-        b = (r // rows_count) * rows_count + (c // colums_count)
-        y_set[(r, c, n)] = [
-            ("rc", (r, c)),
-            ("rn", (r, n)),
-            ("cn", (c, n)),
-            ("bn", (b, n))]
-
-    x_set, y_set = exact_cover(x_set, y_set)
-    for i, row in enumerate(grid):
-        for j, n in enumerate(row):
-            if n:
-                select(x_set, y_set, (i, j, n))
+    """Решение судоку: сначала одиночки на битовых масках,
+    затем перебор оставшихся клеток алгоритмом X (танцующие ссылки)"""
+    board = BitBoard(size, grid)
+    if not board.consistent or not board.propagate():
+        return
+    grid = board.to_matrix()
+    if board.is_filled():
+        yield grid
+        return
 
+    links = DancingLinks(size)
+    links.select_board(board)
     count = 0
-    for solution in solve(x_set, y_set, []):
-        if not solution:
-            return False
-        for (row, col, number) in solution:
+    for solution in links.search():
+        for row_id in solution:
+            row, col, number = links.decode(row_id)
             grid[row][col] = number
         count += 1
         if count > 2:
@@ -106,137 +327,1262 @@ def solve_sudoku(size, grid):
         yield grid
 
 
-def exact_cover(x_set, y_set):
-    x_set = {j: set() for j in x_set}
-    for i, row in y_set.items():
-        for j in row:
-            x_set[j].add(i)
-    return x_set, y_set
-
+def count_solutions(size, grid, limit=2):
+    """Считает решения судоку, останавливаясь на limit-м; сами решения не строятся"""
+    board = BitBoard(size, grid)
+    if not board.consistent or not board.propagate():
+        return 0
+    if board.is_filled():
+        return 1
+
+    links = DancingLinks(size)
+    links.select_board(board)
+    return links.count(limit)
+
+
+def get_column_permutations(size):
+    """Все допустимые перестановки столбцов: порядок вертикальных районов
+    и порядок столбцов внутри каждого из них"""
+    if size not in _COLUMN_PERMUTATIONS_CACHE:
+        orders = list(permutations(range(size)))
+        _COLUMN_PERMUTATIONS_CACHE[size] = [
+            tuple(district * size + col for district, order in zip(districts, inner)
+                  for col in order)
+            for districts in orders for inner in product(orders, repeat=size)]
+    return _COLUMN_PERMUTATIONS_CACHE[size]
+
+
+def canonical_form(size, grid):
+    """Лексикографически минимальный представитель матрицы относительно перестановок
+    строк и столбцов внутри районов, самих районов, транспонирования и перенумерации
+    чисел. Возвращает кортеж чисел по строкам, для size > CANONICAL_MAX_SIZE - None"""
+    if size > CANONICAL_MAX_SIZE:
+        return None
+    n = size ** 2
+    # Строки выбираются по одной с отсечением всего, что больше текущего минимума.
+    # Состояние: (матрица, выбранные строки, перестановка столбцов, нумерация, занято номеров)
+    states = [(matrix, (), cols, (0,) * (n + 1), 0)
+              for matrix in (grid, [list(row) for row in zip(*grid)])
+              for cols in get_column_permutations(size)]
+    result = []
+    for depth in range(n):
+        best = None
+        next_states = []
+        for matrix, used, cols, labels, labels_count in states:
+            if depth % size:
+                start = used[-1] // size * size
+                rows = [row for row in range(start, start + size) if row not in used]
+            else:
+                districts = {row // size for row in used}
+                rows = [row for row in range(n) if row // size not in districts]
+            for row in rows:
+                values = matrix[row]
+                new_labels = list(labels)
+                count = labels_count
+                line = []
+                for col in cols:
+                    value = values[col]
+                    if value:
+                        if not new_labels[value]:
+                            count += 1
+                            new_labels[value] = count
+                        value = new_labels[value]
+                    line.append(value)
+                if best is None or line < best:
+                    best = line
+                    next_states = []
+                if line == best:
+                    next_states.append((matrix, used + (row,), cols, tuple(new_labels), count))
+        result.extend(best)
+        states = next_states
+    return tuple(result)
+
+
+def canonical_hash(size, grid):
+    """Короткий хеш канонической формы матрицы или None, если она не вычисляется"""
+    form = canonical_form(size, grid)
+    if form is None:
+        return None
+    return hashlib.blake2b(bytes(form), digest_size=16).hexdigest()
+
+
+def get_geometry(size):
+    """Возвращает для формы блока size номера строки, столбца и блока каждой клетки
+    и список всех групп (строк, столбцов и блоков) из номеров клеток"""
+    if size not in _GEOMETRY_CACHE:
+        rows_count, colums_count = size
+        cells_count = rows_count * colums_count
+        cell_row, cell_col, cell_box = [], [], []
+        units = [[] for _ in range(3 * cells_count)]
+        for r, c in product(range(cells_count), repeat=2):
+            b = (r // rows_count) * rows_count + (c // colums_count)
+            i = r * cells_count + c
+            cell_row.append(r)
+            cell_col.append(c)
+            cell_box.append(b)
+            units[r].append(i)
+            units[cells_count + c].append(i)
+            units[2 * cells_count + b].append(i)
+        _GEOMETRY_CACHE[size] = (cell_row, cell_col, cell_box, units)
+    return _GEOMETRY_CACHE[size]
+
+
+class BitBoard:
+    """Плоская матрица судоку с битовыми масками чисел, занятых в строках,
+    столбцах и блоках. Бит n - 1 установлен, если число n уже стоит в группе"""
+
+    def __init__(self, size, grid=None):
+        self.size = size
+        self.cells_count = size[0] * size[1]
+        self.full = (1 << self.cells_count) - 1
+        self.cell_row, self.cell_col, self.cell_box, self.units = get_geometry(size)
+        self.values = [0] * self.cells_count ** 2
+        self.rows = [0] * self.cells_count
+        self.cols = [0] * self.cells_count
+        self.boxes = [0] * self.cells_count
+        self.consistent = True
+        if grid is not None:
+            for i, n in enumerate(n for row in grid for n in row):
+                if n and not self.place(i, n):
+                    self.consistent = False
+
+    def copy(self):
+        board = BitBoard.__new__(BitBoard)
+        board.__dict__.update(self.__dict__)
+        board.values = self.values[:]
+        board.rows = self.rows[:]
+        board.cols = self.cols[:]
+        board.boxes = self.boxes[:]
+        return board
+
+    def place(self, i, n):
+        """Ставит число n в клетку i; возвращает False, если число уже занято в группе"""
+        bit = 1 << (n - 1)
+        r, c, b = self.cell_row[i], self.cell_col[i], self.cell_box[i]
+        if (self.rows[r] | self.cols[c] | self.boxes[b]) & bit:
+            return False
+        self.rows[r] |= bit
+        self.cols[c] |= bit
+        self.boxes[b] |= bit
+        self.values[i] = n
+        return True
+
+    def clear(self, i):
+        """Очищает клетку i"""
+        bit = ~(1 << (self.values[i] - 1))
+        self.rows[self.cell_row[i]] &= bit
+        self.cols[self.cell_col[i]] &= bit
+        self.boxes[self.cell_box[i]] &= bit
+        self.values[i] = 0
+
+    def candidates(self, i):
+        """Маска чисел, которые можно поставить в пустую клетку i"""
+        return self.full & ~(self.rows[self.cell_row[i]] | self.cols[self.cell_col[i]] |
+                             self.boxes[self.cell_box[i]])
+
+    def is_filled(self):
+        return 0 not in self.values
+
+    def to_matrix(self):
+        n = self.cells_count
+        return [self.values[i:i + n] for i in range(0, n * n, n)]
+
+    def propagate(self, banned=None):
+        """Расставляет одиночки (naked и hidden singles) до неподвижной точки.
+        banned - словарь {клетка: маска запрещенных в ней чисел}.
+        Возвращает False, если найдено противоречие"""
+        if banned is None:
+            banned = {}
+        values, full = self.values, self.full
+        changed = True
+        while changed:
+            changed = False
+            candidates = {}
+            for i, n in enumerate(values):
+                if n:
+                    continue
+                mask = self.candidates(i) & ~banned.get(i, 0)
+                if not mask:
+                    return False
+                if mask & (mask - 1):
+                    candidates[i] = mask
+                else:
+                    self.place(i, mask.bit_length())
+                    changed = True
+            if changed:
+                continue
+
+            for unit in self.units:
+                once = twice = used = 0
+                empty = []
+                for i in unit:
+                    if values[i]:
+                        used |= 1 << (values[i] - 1)
+                    else:
+                        twice |= once & candidates[i]
+                        once |= candidates[i]
+                        empty.append(i)
+                if once | used != full:
+                    return False
+                singles = once & ~twice & ~used
+                while singles:
+                    bit = singles & -singles
+                    singles ^= bit
+                    n = bit.bit_length()
+                    for i in empty:
+                        if candidates[i] & bit:
+                            if not values[i]:
+                                if not self.place(i, n):
+                                    return False
+                                changed = True
+                            elif values[i] != n:
+                                return False
+                            break
+        return True
+
+
+class BoardState:
+    """Доска во время игры: сколько раз каждое число стоит в каждой группе
+    (строке, столбце, блоке) и маски занятых в группах чисел. Ход и стирание
+    пересчитывают их за O(1), поэтому проверки ниже тоже стоят O(1)"""
+
+    def __init__(self, size, problem, matrix=None):
+        self.cells_count = size ** 2
+        self.full = (1 << self.cells_count) - 1
+        self.cell_row, self.cell_col, self.cell_box, self.units = get_geometry((size, size))
+        self.values = [0] * self.cells_count ** 2
+        self.givens = [bool(value) for row in problem for value in row]
+        # Группы нумеруются как в get_geometry: строки, затем столбцы, затем блоки
+        self.counts = [[0] * (self.cells_count + 1) for _ in range(3 * self.cells_count)]
+        self.masks = [0] * (3 * self.cells_count)
+        # Пар (группа, число), в которых число стоит больше одного раза
+        self.duplicates = 0
+        self.filled = 0
+        if matrix is None:
+            matrix = problem
+        for i, value in enumerate(value for row in matrix for value in row):
+            self.set(i, value)
+
+    def cell_units(self, i):
+        """Номера строки, столбца и блока клетки i среди групп"""
+        return (self.cell_row[i], self.cells_count + self.cell_col[i],
+                2 * self.cells_count + self.cell_box[i])
+
+    def set(self, i, value):
+        """Ставит число value в клетку i; value=0 стирает клетку"""
+        old = self.values[i]
+        if old == value:
+            return
+        units = self.cell_units(i)
+        if old:
+            for unit in units:
+                counts = self.counts[unit]
+                counts[old] -= 1
+                if counts[old] == 1:
+                    self.duplicates -= 1
+                elif not counts[old]:
+                    self.masks[unit] &= ~(1 << (old - 1))
+            self.filled -= 1
+        if value:
+            for unit in units:
+                counts = self.counts[unit]
+                counts[value] += 1
+                if counts[value] == 2:
+                    self.duplicates += 1
+                elif counts[value] == 1:
+                    self.masks[unit] |= 1 << (value - 1)
+            self.filled += 1
+        self.values[i] = value
+
+    def is_conflict(self, i):
+        """Стоит ли число клетки i еще где-то в ее строке, столбце или блоке"""
+        value = self.values[i]
+        return bool(value) and any(self.counts[unit][value] > 1 for unit in self.cell_units(i))
+
+    def get_conflicts(self):
+        return [i for i in range(len(self.values)) if self.is_conflict(i)]
+
+    def candidates(self, i):
+        """Маска чисел, которые не встречаются в группах клетки i (бит n - 1 - число n)"""
+        row, col, box = self.cell_units(i)
+        return self.full & ~(self.masks[row] | self.masks[col] | self.masks[box])
+
+    def get_candidates(self, i):
+        """Пометки карандашом для клетки i: список возможных чисел"""
+        mask = self.candidates(i)
+        return [n + 1 for n in range(self.cells_count) if mask >> n & 1]
+
+    def is_solved(self):
+        return self.filled == len(self.values) and not self.duplicates
+
+
+class HintEngine:
+    """Подсказки по доске BoardState: клетка, число в которой следует из одиночек
+    и исключения кандидатов, и объяснение. Поиск начинается с групп последнего хода.
+    Исключенные кандидаты сохраняются между подсказками, пока числа только добавляются"""
+
+    UNIT_NAMES = ('этой строке', 'этом столбце', 'этом блоке')
+
+    def __init__(self, state):
+        self.state = state
+        n = state.cells_count
+        # Маски кандидатов, исключенных по пересечениям блоков со строками и столбцами
+        self.eliminated = [0] * len(state.values)
+        self.last_cell = None
+        # Пересечения блока и строки или столбца:
+        # (клетки пересечения, остальные клетки блока, остальные клетки строки или столбца)
+        self.segments = []
+        for box in range(2 * n, 3 * n):
+            box_cells = state.units[box]
+            for line in {unit for cell in box_cells for unit in state.cell_units(cell)[:2]}:
+                line_cells = state.units[line]
+                segment = [cell for cell in box_cells if cell in line_cells]
+                self.segments.append((segment,
+                                      [cell for cell in box_cells if cell not in segment],
+                                      [cell for cell in line_cells if cell not in segment]))
+
+    def moved(self, i, old):
+        """Сообщает о ходе в клетку i, где до хода стояло число old"""
+        if old:
+            # После стирания исключенные кандидаты могут вернуться
+            self.eliminated = [0] * len(self.eliminated)
+        self.last_cell = i
+
+    def candidates(self, i):
+        return self.state.candidates(i) & ~self.eliminated[i]
+
+    def hint(self):
+        """Возвращает (клетка, число, объяснение) или None, если на доске есть
+        конфликты или одиночек не находится"""
+        if self.state.duplicates:
+            return None
+        hint = self.find_single()
+        while hint is None and self.eliminate():
+            hint = self.find_single()
+        return hint
+
+    def get_units_order(self):
+        """Номера групп: сначала группы последнего хода, затем остальные"""
+        units = range(len(self.state.units))
+        if self.last_cell is None:
+            return units
+        first = self.state.cell_units(self.last_cell)
+        return list(first) + [unit for unit in units if unit not in first]
+
+    def find_single(self):
+        values = self.state.values
+        units = self.get_units_order()
+        for unit in units:
+            for cell in self.state.units[unit]:
+                if not values[cell]:
+                    mask = self.candidates(cell)
+                    if mask and not mask & (mask - 1):
+                        return cell, mask.bit_length(), \
+                            f'В клетке возможно только число {mask.bit_length()}'
+        for unit in units:
+            once = twice = 0
+            for cell in self.state.units[unit]:
+                if not values[cell]:
+                    mask = self.candidates(cell)
+                    twice |= once & mask
+                    once |= mask
+            hidden = once & ~twice
+            if hidden:
+                bit = hidden & -hidden
+                for cell in self.state.units[unit]:
+                    if not values[cell] and self.candidates(cell) & bit:
+                        name = self.UNIT_NAMES[unit // self.state.cells_count]
+                        return cell, bit.bit_length(), \
+                            f'В {name} число {bit.bit_length()} можно поставить только сюда'
+        return None
+
+    def eliminate(self):
+        """Исключает кандидатов по пересечениям: если в блоке число возможно только
+        в одной строке (столбце), его нет в остальной строке, и наоборот.
+        Возвращает True, если исключен хотя бы один кандидат"""
+        values = self.state.values
+        changed = False
+        for segment, box_rest, line_rest in self.segments:
+            part = 0
+            for cell in segment:
+                if not values[cell]:
+                    part |= self.candidates(cell)
+            if not part:
+                continue
+            box_other = line_other = 0
+            for cell in box_rest:
+                if not values[cell]:
+                    box_other |= self.candidates(cell)
+            for cell in line_rest:
+                if not values[cell]:
+                    line_other |= self.candidates(cell)
+            for locked, cells in ((part & ~box_other, line_rest), (part & ~line_other, box_rest)):
+                if not locked:
+                    continue
+                for cell in cells:
+                    if not values[cell] and self.candidates(cell) & locked:
+                        self.eliminated[cell] |= locked
+                        changed = True
+        return changed
+
+
+class UniquenessChecker:
+    """Проверка единственности решения при поочередном удалении подсказок.
+    Хранит известное решение и маски текущей задачи, поэтому после удаления
+    клетки ищет только решение, в котором эта клетка отличается от известного"""
+
+    def __init__(self, size, solution, problem=None):
+        self.size = size
+        self.solution = BitBoard(size, solution).values
+        self.board = BitBoard(size, solution if problem is None else problem)
 
-def solve(x_set, y_set, solution):
-    if not x_set:
-        yield list(solution)
-    else:
-        c = min(x_set, key=lambda c: len(x_set[c]))
-        for r in list(x_set[c]):
-            solution.append(r)
-            cols = select(x_set, y_set, r)
-            count = 0
-            for s in solve(x_set, y_set, solution):
-                count += 1
-                if count > 2:
-                    yield False
-                yield s
-            deselect(x_set, y_set, r, cols)
-            solution.pop()
+    def has_alternative(self, i):
+        """Есть ли у текущей задачи решение с другим числом в пустой клетке i"""
+        board = self.board.copy()
+        if not board.propagate({i: 1 << (self.solution[i] - 1)}):
+            return False
+        if board.is_filled():
+            return True
+
+        links = DancingLinks(self.size)
+        links.select_board(board)
+        if not board.values[i]:
+            links.exclude(board.cell_row[i], board.cell_col[i], self.solution[i])
+        return links.count(1) > 0
+
+    def remove(self, row, col):
+        """Убирает подсказку, если решение остается единственным; иначе оставляет ее.
+        Возвращает True, если подсказка убрана"""
+        i = row * self.board.cells_count + col
+        self.board.clear(i)
+        if self.has_alternative(i):
+            self.board.place(i, self.solution[i])
+            return False
+        return True
 
+    def restore(self, row, col):
+        """Возвращает ранее убранную подсказку"""
+        i = row * self.board.cells_count + col
+        self.board.place(i, self.solution[i])
 
-def select(x_set, y_set, r):
-    cols = []
-    for j in y_set[r]:
-        for i in x_set[j]:
-            for k in y_set[i]:
-                if k != j:
-                    x_set[k].remove(i)
-        cols.append(x_set.pop(j))
-    return cols
+    def get_problem_matrix(self):
+        return self.board.to_matrix()
+
+
+class DancingLinks:
+    """Танцующие ссылки Кнута на плоских целочисленных массивах.
+    Узел 0 - корень, узлы 1..columns_count - заголовки столбцов,
+    остальные узлы - по четыре на каждую строку (r, c, n) точного покрытия"""
+
+    def __init__(self, size):
+        """Рабочая копия шаблона для формы блока size; шаблон строится один раз"""
+        if size not in _LINKS_CACHE:
+            _LINKS_CACHE[size] = DancingLinks.build_template(size)
+        template = _LINKS_CACHE[size]
+        self.cells_count = template.cells_count
+        self.left = template.left[:]
+        self.right = template.right[:]
+        self.up = template.up[:]
+        self.down = template.down[:]
+        self.counts = template.counts[:]
+        # Эти массивы при покрытии не меняются, поэтому общие для всех копий
+        self.column = template.column
+        self.row = template.row
+        self.first = template.first
+
+    @staticmethod
+    def build_template(size):
+        """Строит полную матрицу точного покрытия для формы блока size"""
+        links = DancingLinks.__new__(DancingLinks)
+        rows_count, colums_count = size
+        cells_count = rows_count * colums_count
+        squares_count = cells_count ** 2
+        columns_count = 4 * squares_count
+        links.cells_count = cells_count
+
+        links.left = [columns_count] + list(range(columns_count))
+        links.right = list(range(1, columns_count + 1)) + [0]
+        links.up = list(range(columns_count + 1))
+        links.down = list(range(columns_count + 1))
+        links.column = list(range(columns_count + 1))
+        links.row = [-1] * (columns_count + 1)
+        links.counts = [0] * (columns_count + 1)
+        links.first = []
+
+        for r, c, n in product(range(cells_count), range(cells_count), range(cells_count)):
+            b = (r // rows_count) * rows_count + (c // colums_count)
+            columns = (1 + r * cells_count + c,
+                       1 + squares_count + r * cells_count + n,
+                       1 + 2 * squares_count + c * cells_count + n,
+                       1 + 3 * squares_count + b * cells_count + n)
+            first = len(links.column)
+            links.first.append(first)
+            for k, col in enumerate(columns):
+                node = first + k
+                links.left.append(first + (k - 1) % 4)
+                links.right.append(first + (k + 1) % 4)
+                links.up.append(links.up[col])
+                links.down.append(col)
+                links.down[links.up[col]] = node
+                links.up[col] = node
+                links.column.append(col)
+                links.row.append(len(links.first) - 1)
+                links.counts[col] += 1
+        return links
+
+    def decode(self, row_id):
+        """Возвращает (строка, столбец, число) по номеру строки точного покрытия"""
+        cell, n = divmod(row_id, self.cells_count)
+        row, col = divmod(cell, self.cells_count)
+        return row, col, n + 1
+
+    def cover(self, c):
+        left, right, up, down = self.left, self.right, self.up, self.down
+        column, counts = self.column, self.counts
+        right[left[c]] = right[c]
+        left[right[c]] = left[c]
+        i = down[c]
+        while i != c:
+            j = right[i]
+            while j != i:
+                down[up[j]] = down[j]
+                up[down[j]] = up[j]
+                counts[column[j]] -= 1
+                j = right[j]
+            i = down[i]
+
+    def uncover(self, c):
+        left, right, up, down = self.left, self.right, self.up, self.down
+        column, counts = self.column, self.counts
+        i = up[c]
+        while i != c:
+            j = left[i]
+            while j != i:
+                counts[column[j]] += 1
+                down[up[j]] = j
+                up[down[j]] = j
+                j = left[j]
+            i = up[i]
+        right[left[c]] = c
+        left[right[c]] = c
+
+    def select(self, row, col, number):
+        """Ставит подсказку в клетку; возвращает False, если она противоречит уже выбранным"""
+        node = self.first[(row * self.cells_count + col) * self.cells_count + number - 1]
+        j = node
+        while True:
+            c = self.column[j]
+            if self.right[self.left[c]] != c:
+                return False
+            j = self.right[j]
+            if j == node:
+                break
+        while True:
+            self.cover(self.column[j])
+            j = self.right[j]
+            if j == node:
+                return True
+
+    def exclude(self, row, col, number):
+        """Убирает из перебора вариант number для клетки (row, col)"""
+        node = self.first[(row * self.cells_count + col) * self.cells_count + number - 1]
+        j = node
+        while True:
+            c = self.column[j]
+            if self.right[self.left[c]] != c:
+                # Строка уже исключена покрытием одного из своих столбцов
+                return
+            j = self.right[j]
+            if j == node:
+                break
+        while True:
+            self.up[self.down[j]] = self.up[j]
+            self.down[self.up[j]] = self.down[j]
+            self.counts[self.column[j]] -= 1
+            j = self.right[j]
+            if j == node:
+                return
+
+    def select_board(self, board):
+        """Ставит все числа заполненных клеток BitBoard как подсказки"""
+        for i, n in enumerate(board.values):
+            if n:
+                self.select(board.cell_row[i], board.cell_col[i], n)
+
+    def choose_column(self):
+        """Непокрытый столбец с наименьшим числом строк"""
+        right, counts = self.right, self.counts
+        c = right[0]
+        j = right[c]
+        while j and counts[c] > 1:
+            if counts[j] < counts[c]:
+                c = j
+            j = right[j]
+        return c
+
+    def search(self, solution=None):
+        """Генератор решений, каждое решение - список номеров выбранных строк"""
+        if solution is None:
+            solution = []
+        right, left, down = self.right, self.left, self.down
+        column = self.column
+        if right[0] == 0:
+            yield list(solution)
+            return
+
+        c = self.choose_column()
+        if not self.counts[c]:
+            return
+
+        self.cover(c)
+        r = down[c]
+        while r != c:
+            solution.append(self.row[r])
+            j = right[r]
+            while j != r:
+                self.cover(column[j])
+                j = right[j]
+            yield from self.search(solution)
+            j = left[r]
+            while j != r:
+                self.uncover(column[j])
+                j = left[j]
+            solution.pop()
+            r = down[r]
+        self.uncover(c)
+
+    def count(self, limit):
+        """Считает решения, прекращая перебор после limit найденных"""
+        right, left, down = self.right, self.left, self.down
+        column = self.column
+        if right[0] == 0:
+            return 1
+
+        c = self.choose_column()
+        if not self.counts[c]:
+            return 0
+
+        found = 0
+        self.cover(c)
+        r = down[c]
+        while r != c and found < limit:
+            j = right[r]
+            while j != r:
+                self.cover(column[j])
+                j = right[j]
+            found += self.count(limit - found)
+            j = left[r]
+            while j != r:
+                self.uncover(column[j])
+                j = left[j]
+            r = down[r]
+        self.uncover(c)
+        return found
+
+
+def get_connection(db_path):
+    """Возвращает общее для всего процесса соединение с базой db_path и блокировку
+    для записи через него. При первом открытии создает или обновляет схему"""
+    with _CONNECTIONS_LOCK:
+        if db_path not in _CONNECTIONS:
+            connection = sqlite3.connect(db_path, check_same_thread=False)
+            # WAL не дает фоновой записи блокировать чтение, а NORMAL в режиме WAL
+            # синхронизирует диск только на контрольных точках
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            prepare_database(connection)
+            _CONNECTIONS[db_path] = connection, Lock()
+        return _CONNECTIONS[db_path]
+
+
+def close_connection(db_path):
+    """Закрывает общее соединение с базой db_path, если оно было открыто"""
+    with _CONNECTIONS_LOCK:
+        if db_path in _CONNECTIONS:
+            connection, lock = _CONNECTIONS.pop(db_path)
+            with lock:
+                connection.close()
+
+
+def format_time(game_seconds):
+    """Время игры в виде [часы:]минуты:секунды"""
+    hours = game_seconds // 3600
+    minutes = game_seconds // 60 % 60
+    seconds = game_seconds % 60
+    return (str(hours) + ':' if hours else '') + f'{minutes}' + ':' + f'{seconds}'.rjust(2, '0')
+
+
+def get_writer(db_path):
+    """Возвращает общий для процесса поток записи в базу db_path, запуская его
+    при первом обращении"""
+    get_connection(db_path)
+    with _CONNECTIONS_LOCK:
+        if db_path not in _WRITERS:
+            writer = DataBaseWriter(db_path)
+            writer.start()
+            _WRITERS[db_path] = writer
+        return _WRITERS[db_path]
+
+
+def close_writer(db_path, timeout=DB_WRITER_CLOSE_TIMEOUT):
+    """Дописывает очередь потока записи в базу db_path, ожидая не дольше timeout секунд"""
+    with _CONNECTIONS_LOCK:
+        writer = _WRITERS.pop(db_path, None)
+    if writer is not None:
+        writer.close(timeout)
+
+
+def sudoku_to_row(sudoku, status) -> tuple:
+    """Параметры INSERT_SUDOKU_QUERY для судоку"""
+    return (sudoku.get_size(),
+            sudoku.get_difficult_level_name(),
+            sudoku.get_timestamp(),
+            encode_matrix(sudoku.solved_sudoku),
+            encode_matrix(sudoku.problem_sudoku),
+            status,
+            sudoku.get_canonical_hash(),
+            int(sudoku.isomorph))
+
+
+def prepare_database(connection):
+    """Создает схему в новой базе или доводит схему существующей до DB_SCHEMA_VERSION"""
+    cursor = connection.cursor()
+    has_tables = cursor.execute("""SELECT COUNT(*) FROM sqlite_master
+        WHERE type = 'table' AND name = 'matrixes'""").fetchone()[0]
+    if not has_tables:
+        run_migration(connection, DB_SCHEMA_VERSION, CREATE_DATABASE_SCRIPT)
+        return
+    version = cursor.execute('PRAGMA user_version').fetchone()[0]
+    for next_version in range(version + 1, DB_SCHEMA_VERSION + 1):
+        run_migration(connection, next_version, MIGRATION_SCRIPTS.get(next_version, ''),
+                      MIGRATION_FUNCTIONS.get(next_version))
+
+
+def run_migration(connection, version, script, function=None):
+    """Выполняет скрипт и функцию обновления и записывает номер версии схемы
+    в одной транзакции: прерванное обновление не оставляет базу между версиями"""
+    try:
+        # executescript сам фиксирует открытую транзакцию, поэтому BEGIN идет внутри скрипта
+        connection.executescript('BEGIN;\n' + script)
+        if function is not None:
+            function(connection)
+        connection.execute(f'PRAGMA user_version = {version}')
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+
+
+def encode_matrix(matrix) -> bytes:
+    """Двоичная запись матрицы: версия формата, длина стороны, затем клетки по строкам.
+    Пока числа помещаются в 4 бита (сторона до 15), в байте две клетки, иначе одна"""
+    side = len(matrix)
+    values = [value for row in matrix for value in row]
+    if side < 16:
+        if len(values) % 2:
+            values.append(0)
+        body = bytes(values[i] << 4 | values[i + 1] for i in range(0, len(values), 2))
+    else:
+        body = bytes(values)
+    return bytes((MATRIX_FORMAT_VERSION, side)) + body
 
 
-def deselect(x_set, y_set, r, cols):
-    for j in reversed(y_set[r]):
-        x_set[j] = cols.pop()
-        for i in x_set[j]:
-            for k in y_set[i]:
-                if k != j:
-                    x_set[k].add(i)
+def decode_matrix(data: bytes) -> list:
+    """Матрица из записи encode_matrix"""
+    version, side = data[0], data[1]
+    if version != MATRIX_FORMAT_VERSION:
+        raise ValueError(f'Неизвестная версия формата матрицы: {version}')
+    if side < 16:
+        values = [value for byte in data[2:] for value in _NIBBLES[byte]]
+    else:
+        values = list(data[2:])
+    return [values[i:i + side] for i in range(0, side * side, side)]
+
+
+def str_to_matrix(s: str) -> list:
+    """Матрица из строковой записи первой версии базы: '1-2-3=4-5-6=...'"""
+    return [[int(x) for x in row.split('-')] for row in s.split('=')]
+
+
+def migrate_matrixes_to_blobs(connection):
+    """Перекодирует матрицы, сохраненные строками, в двоичный формат
+    и заполняет отсутствующие хеши канонических форм"""
+    cursor = connection.cursor()
+    rows = cursor.execute("""SELECT id, size, solved_matrix, problem_matrix FROM matrixes
+        WHERE typeof(problem_matrix) = 'text'""").fetchall()
+    # Транзакцию открывает и фиксирует run_migration
+    for row_id, size, solved_matrix, problem_matrix in rows:
+        solved_matrix = str_to_matrix(solved_matrix)
+        problem_matrix = str_to_matrix(problem_matrix)
+        cursor.execute('UPDATE matrixes SET solved_matrix = ?, problem_matrix = ? WHERE id = ?',
+                       (encode_matrix(solved_matrix), encode_matrix(problem_matrix), row_id))
+        # Повтор уже сохраненного судоку остается без хеша
+        cursor.execute("""UPDATE OR IGNORE matrixes SET canonical_hash = ?
+            WHERE id = ? AND canonical_hash IS NULL""",
+                       (canonical_hash(size, problem_matrix), row_id))
+
+
+MIGRATION_FUNCTIONS = {
+    3: migrate_matrixes_to_blobs
+}
 
 
 class MyDataBaseCursor:
     def __init__(self, db_path: str):
-        files = list(os.walk(os.getcwd()))[0][-1]
-        new_db = False
-        if db_path not in files:
-            with open(db_path, 'w', encoding='utf-8'):
-                pass
-            new_db = True
-        self.connection = sqlite3.connect(db_path)
+        self.db_path = db_path
+        self.connection, self.lock = get_connection(db_path)
         self.cursor = self.connection.cursor()
-        if new_db:
-            self.cursor.executescript(CREATE_DATABASE_SCRIPT)
-
-    def insert_sudoku_into_db(self, sudoku, status) -> None:
-        problem_matrix = self._matrix_to_str(sudoku.get_problem_matrix())
-        solved_matrix = self._matrix_to_str(sudoku.get_solved_matrix())
-        sudoku_level = sudoku.get_difficult_level_name()
-        timestamp = sudoku.get_timestamp()
-        size = sudoku.get_size()
-
-        data = {'problem_matrix': '\'' + problem_matrix + '\'',
-                'solved_matrix': '\'' + solved_matrix + '\'',
-                'level': '\'' + sudoku_level + '\'',
-                'timestamp': timestamp,
-                'size': size,
-                'status': '\'' + status + '\''}
-
-        print(f"""INSERT INTO matrixes({', '.join([str(key) for key in
-                                                                 data.keys()])})
-        VALUES ({', '.join([str(data[key]) for key in data.keys()])})""")
-
-        self.cursor.execute(f"""INSERT INTO matrixes({', '.join([str(key) for key in
-                                                                 data.keys()])})
-        VALUES ({', '.join([str(data[key]) for key in data.keys()])})""")
-        self.connection.commit()
-
-    def get_sudoku_from_db(self, **kwargs):
-        # TODO
-        pass
-
-    def _matrix_to_str(self, matrix: list) -> str:
-        temp = []
-        for row in matrix:
-            temp += ['-'.join([str(x) for x in row])]
-        return '='.join(temp)
-
-    def _str_to_matrix(self, s: str) -> list:
-        return [row.strip()[1:-1].split(', ') for row in s.strip()[1:-1].split(', ')]
 
-    def get_data(self, **kwargs):
-        kwargs = list(kwargs)
+    def get_sudoku_from_db(self, level, size=3):
+        """Забирает из базы заготовленный судоку уровня level и размера size.
+        Возвращает готовый Sudoku или None, если заготовок не осталось"""
+        with self.lock:
+            with self.connection:
+                row = self.connection.execute(CLAIM_SUDOKU_QUERY, (size, level)).fetchone()
+        if row is None:
+            return None
+        matrix_id, timestamp, solved_matrix, problem_matrix = row
+        sudoku = Sudoku(size, level, timestamp,
+                        decode_matrix(solved_matrix), decode_matrix(problem_matrix))
+        sudoku.matrix_id = matrix_id
+        return sudoku
+
+    def get_saved_game(self, size=3, exclude_game_id=None):
+        """Последняя незаконченная игра размера size, кроме exclude_game_id.
+        Доска восстанавливается из снимка и журнала ходов.
+        Возвращает (game_id, Sudoku, доска, game_seconds) или None"""
+        with self.lock:
+            row = self.connection.execute(LAST_GAME_QUERY, (size, exclude_game_id)).fetchone()
+            if row is None:
+                return None
+            (game_id, matrix_id, level, timestamp, solved_matrix, problem_matrix, board,
+             game_seconds) = row
+            moves = self.connection.execute(GAME_MOVES_QUERY, (game_id,)).fetchall()
+        sudoku = Sudoku(size, level, timestamp, decode_matrix(solved_matrix),
+                        decode_matrix(problem_matrix))
+        sudoku.matrix_id = matrix_id
+        matrix = decode_matrix(board)
+        side = len(matrix)
+        for cell, value in moves:
+            matrix[cell // side][cell % side] = value
+        return game_id, sudoku, matrix, game_seconds
+
+    def get_data(self, level=None, matrix_id=None, limit=LEADERS_PAGE_SIZE, offset=0):
+        """Страница таблицы рекордов. По уровню level (None - все уровни) читается
+        сводная таблица: (место, игрок, уровень, лучшее время, число попыток).
+        Если задан matrix_id, места считаются по записям прохождений этой матрицы:
+        (место, игрок, уровень, время, дата)"""
+        if matrix_id is not None:
+            query, parameters = LEADERS_BY_MATRIX_QUERY, (matrix_id, limit, offset)
+        elif level is not None:
+            query, parameters = LEADERS_BY_LEVEL_QUERY, (level, limit, offset)
+        else:
+            query, parameters = LEADERS_QUERY, (limit, offset)
+        return self.connection.execute(query, parameters).fetchall()
 
     def terminate(self):
-        self.connection.close()
+        close_connection(self.db_path)
 
     def execute(self, *args, **kwargs):
         return self.cursor.execute(*args, **kwargs)
 
 
+class DataBaseWriter(Thread):
+    """Единственный поток, который пишет в базу. Работа приходит через очередь
+    и выполняется пачками, каждая пачка - одна транзакция"""
+
+    def __init__(self, db_path, interval=DB_WRITER_INTERVAL, batch_size=DB_WRITER_BATCH_SIZE):
+        super().__init__(name='database_writer', daemon=True)
+        self.db_path = db_path
+        self.interval = interval
+        self.batch_size = batch_size
+        self.queue = Queue()
+
+    def execute(self, query, parameters=()):
+        self.queue.put((query, [parameters]))
+
+    def executemany(self, query, rows):
+        self.queue.put((query, list(rows)))
+
+    def insert_sudokus(self, sudokus, status):
+        """Ставит в очередь сохранение судоку заданиями по batch_size строк; повторы
+        с точностью до симметрий пропускаются. Строки вместе с хешами канонических форм
+        готовятся в вызывающем потоке, поток записи только пишет"""
+        rows = [sudoku_to_row(sudoku, status) for sudoku in sudokus]
+        for start in range(0, len(rows), self.batch_size):
+            self.executemany(INSERT_SUDOKU_QUERY, rows[start:start + self.batch_size])
+
+    def insert_game(self, game_id, sudoku, matrix, game_seconds):
+        """Ставит в очередь создание незаконченной игры с доской matrix"""
+        self.execute(INSERT_GAME_QUERY, (game_id, sudoku.matrix_id, sudoku.get_size(),
+                                         sudoku.get_difficult_level_name(),
+                                         sudoku.get_timestamp(),
+                                         encode_matrix(sudoku.solved_sudoku),
+                                         encode_matrix(sudoku.problem_sudoku),
+                                         encode_matrix(matrix), game_seconds, int(time.time())))
+
+    def insert_moves(self, game_id, moves, game_seconds):
+        """Ставит в очередь дописывание ходов (клетка, число) в журнал игры"""
+        self.executemany(INSERT_MOVE_QUERY, [(game_id, cell, value) for cell, value in moves])
+        self.execute(UPDATE_GAME_TIME_QUERY, (game_seconds, int(time.time()), game_id))
+
+    def compact_game(self, game_id, matrix, game_seconds):
+        """Ставит в очередь замену снимка доски игры на matrix и очистку журнала ходов"""
+        self.execute(COMPACT_GAME_QUERY, (encode_matrix(matrix), game_seconds,
+                                          int(time.time()), game_id))
+        self.execute(DELETE_MOVES_QUERY, (game_id,))
+
+    def finish_game(self, game_id, status):
+        """Ставит в очередь смену статуса игры и удаление ее журнала ходов"""
+        self.execute("UPDATE games SET status = ? WHERE id = ?", (status, game_id))
+        self.execute(DELETE_MOVES_QUERY, (game_id,))
+
+    def wait(self, timeout=DB_WRITER_CLOSE_TIMEOUT) -> bool:
+        """Ждет, пока будет записано все, что поставлено в очередь до вызова"""
+        done = Event()
+        self.queue.put((None, done))
+        return done.wait(timeout)
+
+    def insert_record(self, user_name, sudoku, game_seconds):
+        """Ставит в очередь результат игрока user_name в судоку, создавая игрока
+        при необходимости. Судоку, которого еще нет в базе, сохраняется перед записью"""
+        date = datetime.date.today().isoformat()
+        self.execute(INSERT_USER_QUERY, (user_name, user_name))
+        if sudoku.matrix_id is not None:
+            self.execute(INSERT_RECORD_QUERY, (user_name, sudoku.matrix_id, game_seconds, date))
+            return
+        row = sudoku_to_row(sudoku, 'IN_USE')
+
+        def insert(connection):
+            # Судоку и запись вставляются одним заданием, чтобы между ними
+            # не попали вставки из других потоков
+            cursor = connection.execute(INSERT_SUDOKU_QUERY, row)
+            if cursor.rowcount:
+                matrix_id = cursor.lastrowid
+            else:
+                matrix_id = connection.execute("""SELECT id FROM matrixes
+                    WHERE canonical_hash = ? AND isomorph = 0""", (row[6],)).fetchone()[0]
+            connection.execute(INSERT_RECORD_QUERY, (user_name, matrix_id, game_seconds, date))
+            sudoku.matrix_id = matrix_id
+
+        self.call(insert)
+
+    def call(self, function):
+        """Ставит в очередь функцию function(connection), которая выполнится
+        в потоке записи внутри транзакции пачки"""
+        self.queue.put((function, None))
+
+    def close(self, timeout=DB_WRITER_CLOSE_TIMEOUT):
+        """Дописывает все поставленные задания и останавливает поток"""
+        self.queue.put(None)
+        self.join(timeout)
+
+    def run(self):
+        connection = sqlite3.connect(self.db_path)
+        connection.execute('PRAGMA synchronous = NORMAL')
+        stopped = False
+        while not stopped:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except Empty:
+                    break
+                if item is None:
+                    stopped = True
+                    break
+                batch.append(item)
+            self.write(connection, batch)
+            for query, done in batch:
+                if query is None:
+                    done.set()
+        connection.close()
+
+    @staticmethod
+    def write(connection, batch):
+        batch = [(query, rows) for query, rows in batch if query is not None]
+        try:
+            with connection:
+                for query, rows in batch:
+                    DataBaseWriter.write_item(connection, query, rows)
+        except sqlite3.Error as e:
+            print(e)
+            # Ошибочное задание не должно откатывать остальные
+            for query, rows in batch:
+                try:
+                    with connection:
+                        DataBaseWriter.write_item(connection, query, rows)
+                except sqlite3.Error as e:
+                    print(e)
+
+    @staticmethod
+    def write_item(connection, query, rows):
+        if callable(query):
+            query(connection)
+        else:
+            connection.executemany(query, rows)
+
+
 class MyThread(Thread):
-    def __init__(self, sudoku_level_name, log=None, name='unnamed_thread'):
+    def __init__(self, sudoku_level_name, log=None, name='unnamed_thread', isomorphs_count=0,
+                 size=3):
+        """sudoku_level_name=None генерирует за один прогон судоку всех уровней.
+        isomorphs_count - сколько изоморфов каждого судоку сохранить вместе с ним"""
         super().__init__()
+        self.size = size
         if log is None:
             log = []
         self.log = log
         self.sudoku_level_name = sudoku_level_name
-        self.sudoku_level = LEVELS_SETTINGS[sudoku_level_name]
+        self.sudoku_level = LEVELS_SETTINGS.get(sudoku_level_name)
         self.name = name
+        self.isomorphs_count = isomorphs_count
 
     def run(self):
-        sudoku = Sudoku()
+        sudoku = Sudoku(self.size)
         now = datetime.datetime.now()
-        sudoku.generate_sudoku(self.sudoku_level_name)
+        if self.sudoku_level_name is None:
+            sudokus = list(sudoku.generate_sudoku_levels().values())
+        else:
+            sudoku.generate_sudoku(self.sudoku_level_name)
+            sudokus = [sudoku]
         t = datetime.datetime.now() - now
         temp = []
         temp.append('=' * 100)
         temp.append(' '.join(['Поток', self.name,
-                              self.sudoku_level_name,
+                              str(self.sudoku_level_name),
                               'завершил работу за',
-                              str(t.microseconds / 1000000), 'секунд']))
-        temp.append(sudoku)
+                              str(t.total_seconds()), 'секунд']))
+        temp.append(sudokus)
         self.log.append(temp)
         print(temp)
 
-        MyDataBaseCursor(DB_NAME).insert_sudoku_into_db(sudoku, status='PRELOADED')
+        batch = []
+        for sudoku in sudokus:
+            batch.append(sudoku)
+            batch.extend(sudoku.generate_isomorphs(self.isomorphs_count))
+        get_writer(DB_NAME).insert_sudokus(batch, status='PRELOADED')
+
+
+def init_generation_process(cancel_flags):
+    global _CANCEL_FLAGS
+    _CANCEL_FLAGS = cancel_flags
+
+
+def generate_in_process(size, level_name, isomorphs_count=0, slot=None):
+    """Выполняется в процессе пула: генерирует судоку уровня level_name (None - всех
+    уровней за один прогон) с изоморфами и возвращает их сериализованными.
+    Пока идет удаление клеток, проверяется флаг отмены slot; отмененное задание
+    возвращает пустой список"""
+    def progress(removed, target, attempts):
+        return not _CANCEL_FLAGS[slot]
+
+    if slot is None or _CANCEL_FLAGS is None:
+        progress = None
+    elif _CANCEL_FLAGS[slot]:
+        return []
+    sudoku = Sudoku(size)
+    if level_name is None:
+        sudokus = list(sudoku.generate_sudoku_levels(progress).values())
+    else:
+        sudoku.generate_sudoku(level_name, progress=progress)
+        sudokus = [sudoku]
+    if progress is not None and not progress(0, 0, 0):
+        return []
+    result = []
+    for sudoku in sudokus:
+        for item in [sudoku] + list(sudoku.generate_isomorphs(isomorphs_count)):
+            result.append(serialize_sudoku(item))
+    return result
+
+
+def serialize_sudoku(sudoku) -> tuple:
+    """Кортеж из байтов и чисел для передачи судоку между процессами"""
+    return (sudoku.size, sudoku.difficult_level_name, sudoku.timestamp,
+            encode_matrix(sudoku.solved_sudoku), encode_matrix(sudoku.problem_sudoku),
+            sudoku.get_canonical_hash(), sudoku.isomorph)
+
+
+def deserialize_sudoku(data):
+    size, level_name, timestamp, solved_matrix, problem_matrix, sudoku_hash, isomorph = data
+    sudoku = Sudoku(size, level_name, timestamp,
+                    decode_matrix(solved_matrix), decode_matrix(problem_matrix))
+    sudoku.sudoku_hash = sudoku_hash
+    sudoku.isomorph = isomorph
+    return sudoku
+
+
+class GenerationPool:
+    """Генерация судоку в пуле процессов. Работа чисто вычислительная, поэтому
+    потоки только мешали бы друг другу и циклу событий Qt из-за GIL"""
+
+    def __init__(self, workers_count=None):
+        self.workers_count = workers_count or os.cpu_count() or 1
+        # spawn: дочерние процессы не наследуют потоки Qt родителя
+        context = multiprocessing.get_context('spawn')
+        # Флаги отмены в общей памяти, по одному на слот номера задания
+        self.cancel_flags = context.Array('b', GENERATION_CANCEL_SLOTS)
+        self.executor = ProcessPoolExecutor(self.workers_count, mp_context=context,
+                                            initializer=init_generation_process,
+                                            initargs=(self.cancel_flags,))
+        self.jobs = {}
+        self.last_job_id = 0
+
+    def submit(self, size, level_name, isomorphs_count=0, callback=None):
+        """Ставит генерацию в очередь и возвращает номер задания. callback получает
+        список Sudoku в служебном потоке пула, если задание не отменено"""
+        self.last_job_id += 1
+        job_id = self.last_job_id
+        slot = job_id % GENERATION_CANCEL_SLOTS
+        self.cancel_flags[slot] = 0
+
+        def finished(future):
+            cancelled = self.jobs.pop(job_id, None) is None
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                print(future.exception())
+            elif not cancelled and callback is not None:
+                callback([deserialize_sudoku(data) for data in future.result()])
+
+        future = self.executor.submit(generate_in_process, size, level_name, isomorphs_count,
+                                      slot)
+        self.jobs[job_id] = future
+        future.add_done_callback(finished)
+        return job_id
+
+    def is_running(self, job_id):
+        return job_id in self.jobs
+
+    def cancel(self, job_id):
+        """Отменяет задание: из очереди оно снимается, а запущенное прекращает
+        удаление клеток при следующей проверке флага; результат выбрасывается"""
+        future = self.jobs.pop(job_id, None)
+        if future is not None and not future.cancel():
+            self.cancel_flags[job_id % GENERATION_CANCEL_SLOTS] = 1
+
+    def shutdown(self):
+        """Отменяет все задания и дожидается остановки процессов пула"""
+        for job_id in list(self.jobs):
+            self.cancel(job_id)
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+class SudokuBank:
+    """Запас заготовленных судоку. Когда число заготовок какого-то размера и уровня
+    падает ниже low_watermark, фоновая генерация пополняет его до high_watermark"""
+
+    def __init__(self, database_cursor, pool, sizes=(3,), low_watermark=BANK_LOW_WATERMARK,
+                 high_watermark=BANK_HIGH_WATERMARK):
+        self.database_cursor = database_cursor
+        self.pool = pool
+        self.sizes = sizes
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        # Пары (размер, уровень), которые пополняются до high_watermark
+        self.filling = set()
+        # Задания пула и пары, которые они генерируют
+        self.jobs = {}
+
+    def get_counts(self):
+        """Возвращает словарь {(размер, уровень): число заготовок}"""
+        rows = self.database_cursor.execute("""SELECT size, level, COUNT(*) FROM matrixes
+            WHERE status = 'PRELOADED' GROUP BY size, level""").fetchall()
+        return {(size, level): count for size, level, count in rows}
+
+    def refill(self, game_active=False):
+        """Проверяет запас и ставит в пул генерацию для пар, которые нужно пополнить.
+        Во время игры выполняется не больше BANK_GAME_JOBS_COUNT заданий"""
+        self.jobs = {job_id: keys for job_id, keys in self.jobs.items()
+                     if self.pool.is_running(job_id)}
+        jobs_limit = BANK_GAME_JOBS_COUNT if game_active else self.pool.workers_count
+        # Когда начинается игра, лишние задания, начиная с последних, отменяются
+        for job_id in sorted(self.jobs)[jobs_limit:]:
+            self.pool.cancel(job_id)
+            del self.jobs[job_id]
+        if len(self.jobs) >= jobs_limit:
+            return
+
+        counts = self.get_counts()
+        for size in self.sizes:
+            for level_name in LEVELS_SETTINGS:
+                count = counts.get((size, level_name), 0)
+                if count < self.low_watermark:
+                    self.filling.add((size, level_name))
+                elif count >= self.high_watermark:
+                    self.filling.discard((size, level_name))
+
+        for size in self.sizes:
+            while len(self.jobs) < jobs_limit:
+                levels = [level_name for level_name in LEVELS_SETTINGS
+                          if (size, level_name) in self.filling and
+                          counts.get((size, level_name), 0) +
+                          self.get_expected_count((size, level_name)) < self.high_watermark]
+                if not levels:
+                    break
+                # Несколько уровней дешевле получить за один прогон удаления клеток
+                level_name = levels[0] if len(levels) == 1 else None
+                job_id = self.pool.submit(size, level_name, BANK_ISOMORPHS_COUNT, self.store)
+                self.jobs[job_id] = {(size, name) for name in
+                                     (levels if level_name else LEVELS_SETTINGS)}
+
+    def get_expected_count(self, key):
+        """Сколько заготовок пары key самое большее принесут уже поставленные задания:
+        прогон за все уровни может не дать самый сложный"""
+        jobs_count = sum(1 for keys in self.jobs.values() if key in keys)
+        return jobs_count * (1 + BANK_ISOMORPHS_COUNT)
+
+    def store(self, sudokus):
+        get_writer(self.database_cursor.db_path).insert_sudokus(sudokus, status='PRELOADED')
+
+
+class GameAutosave:
+    """Автосохранение незаконченной игры. Ходы копятся в памяти и уходят в журнал
+    через поток записи только при flush; повторные ходы в одну клетку схлопываются"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.game_id = None
+        # Несохраненные ходы {номер клетки: число}
+        self.pending = {}
+        # Ходов в журнале после последнего снимка доски
+        self.moves_count = 0
+
+    def start(self, sudoku, matrix, game_seconds=0, game_id=None):
+        """Начинает сохранять игру; game_id задается, когда игра продолжается из базы"""
+        self.pending = {}
+        self.moves_count = 0
+        if game_id is None:
+            game_id = uuid.uuid4().hex
+            get_writer(self.db_path).insert_game(game_id, sudoku, matrix, game_seconds)
+        self.game_id = game_id
+
+    def record(self, cell, value):
+        self.pending[cell] = value
+
+    def flush(self, matrix, game_seconds):
+        """Отправляет накопленные ходы; длинный журнал заменяется снимком доски matrix"""
+        if self.game_id is None:
+            return
+        writer = get_writer(self.db_path)
+        self.moves_count += len(self.pending)
+        if self.moves_count >= GAME_COMPACT_MOVES:
+            writer.compact_game(self.game_id, matrix, game_seconds)
+            self.moves_count = 0
+        else:
+            writer.insert_moves(self.game_id, self.pending.items(), game_seconds)
+        self.pending = {}
+
+    def finish(self, status):
+        """Закрывает игру: больше она не предлагается для продолжения"""
+        if self.game_id is not None:
+            get_writer(self.db_path).finish_game(self.game_id, status)
+        self.game_id = None
+        self.pending = {}
 
 
 class Sudoku:
@@ -252,10 +1598,14 @@ class Sudoku:
         self.timestamp = timestamp
         self.difficult_level_name = level
         self.constant = True if self.solved_sudoku else False
+        self.sudoku_hash = None
+        self.isomorph = False
+        self.matrix_id = None
 
     def initialize_matrix(self):
         self.solved_sudoku = []
         self.problem_sudoku = []
+        self.sudoku_hash = None
 
     def generate_initial_district(self, shift):
         """Генерирует и возвращает начальный район из self.size квадратных блоков со сдвигом shift"""
@@ -272,56 +1622,78 @@ class Sudoku:
 
     def transpose_matrix(self):
         """Транспонирует матрицу"""
+        self.solved_sudoku = [list(row) for row in zip(*self.solved_sudoku)]
 
-        self.solved_sudoku = list(map(list, zip(*copy.deepcopy(self.solved_sudoku))))
+    def _swap_inside_district(self, lines):
+        """Обменивает два случайных элемента lines внутри одного района"""
+        start = random.choice(range(self.size))
+        first, second = random.sample(range(start * self.size, start * self.size + self.size), 2)
+        lines[first], lines[second] = lines[second], lines[first]
+
+    def _swap_districts(self, lines):
+        """Обменивает в lines два случайных района"""
+        first, second = random.sample(range(self.size), 2)
+        for i in range(self.size):
+            lines[first * self.size + i], lines[second * self.size + i] = \
+                lines[second * self.size + i], lines[first * self.size + i]
+
+    def _permute_cols(self, cols):
+        self.solved_sudoku = [[row[col] for col in cols] for row in self.solved_sudoku]
 
     def change_rows(self):
         """Обменивает две случайные строки внутри одного района"""
-        start = random.choice(range(self.size))
-        variants = list(range(start * self.size, start * self.size + self.size))
-        random.shuffle(variants)
-        first = variants.pop()
-        second = variants.pop()
-        self.solved_sudoku[first], self.solved_sudoku[second] = self.solved_sudoku[second], \
-                                                                self.solved_sudoku[first]
+        self._swap_inside_district(self.solved_sudoku)
 
     def change_cols(self):
         """Обменивает два случайных столбца внутри одного района"""
-        self.transpose_matrix()
-        self.change_rows()
-        self.transpose_matrix()
+        cols = list(range(self.size ** 2))
+        self._swap_inside_district(cols)
+        self._permute_cols(cols)
 
     def change_row_districts(self):
         """Обменивает два случайных горизонтальных района"""
-        variants = list(range(self.size))
-        first = random.choice(variants)
-        variants.remove(first)
-        second = random.choice(variants)
-
-        for i in range(self.size):
-            self.solved_sudoku[first * self.size + i], \
-            self.solved_sudoku[second * self.size + i] = self.solved_sudoku[
-                                                             second * self.size + i], \
-                                                         self.solved_sudoku[first * self.size + i]
+        self._swap_districts(self.solved_sudoku)
 
     def change_col_districts(self):
         """Обменивает два случайных вертикальных района"""
-        self.transpose_matrix()
-        self.change_row_districts()
-        self.transpose_matrix()
+        cols = list(range(self.size ** 2))
+        self._swap_districts(cols)
+        self._permute_cols(cols)
+
+    def random_transform(self, k=10):
+        """Собирает k случайных допустимых действий и перестановку чисел в одно преобразование
+        (перестановка строк, перестановка столбцов, транспонирование, перестановка чисел)"""
+        rows = list(range(self.size ** 2))
+        cols = list(range(self.size ** 2))
+        transposed = False
+        for _ in range(k):
+            action = random.randrange(5)
+            if action == 0:
+                rows, cols, transposed = cols, rows, not transposed
+            elif action == 1:
+                self._swap_inside_district(rows)
+            elif action == 2:
+                self._swap_inside_district(cols)
+            elif action == 3:
+                self._swap_districts(rows)
+            else:
+                self._swap_districts(cols)
+        digits = [0] + random.sample(range(1, self.size ** 2 + 1), self.size ** 2)
+        return rows, cols, transposed, digits
+
+    @staticmethod
+    def transform_matrix(matrix, transform):
+        """Возвращает новую матрицу, полученную преобразованием из random_transform;
+        пустые клетки остаются пустыми"""
+        rows, cols, transposed, digits = transform
+        if transposed:
+            matrix = list(zip(*matrix))
+        return [[digits[matrix[row][col]] for col in cols] for row in rows]
 
     def random_mix_matrix(self, k=10):
         """Совершает k случайных действий над матрицей,
-         не приводящих к недопустимым позициям"""
-        mix_functions = [self.transpose_matrix,
-                         self.change_rows,
-                         self.change_cols,
-                         self.change_row_districts,
-                         self.change_col_districts]
-
-        for _ in range(k):
-            mix_function = random.choice(mix_functions)
-            mix_function()
+         не приводящих к недопустимым позициям, и переставляет числа"""
+        self.solved_sudoku = self.transform_matrix(self.solved_sudoku, self.random_transform(k))
 
     def _show_matrix_as_sudoku(self, showed_matrix):
         """Выводит матрицу в консоль в виде судоку"""
@@ -356,10 +1728,75 @@ class Sudoku:
          генерирует новую матрицу"""
         self.size = size
 
-    def generate_sudoku(self, difficult_level_name):
+    def carve(self, difficult_max, progress=None, deadline=None):
+        """Удаляет из заполненной матрицы до difficult_max клеток так, чтобы решение
+        оставалось единственным. Возвращает удаленные клетки в порядке удаления:
+        после удаления любого начала этого списка решение тоже единственно.
+        Каждые CARVE_PROGRESS_ATTEMPTS попыток вызывается progress(удалено, цель, попытки);
+        если он вернет False или наступит момент deadline по time.monotonic(),
+        удаление прекращается с лучшим найденным результатом"""
+        variants = [(row, col) for row in range(self.size ** 2)
+                    for col in range(self.size ** 2)]
+        random.shuffle(variants)
+        position = len(variants)
+
+        # Журнал удаленных клеток: (клетка, число, позиция в variants после удаления)
+        history = []
+
+        maximum_difficult = 0
+        maximum_history = []
+
+        attempts = 0
+        max_attempts_count = ATTEMPTS_MAX_COUNT
+
+        checker = UniquenessChecker((self.size, self.size), self.solved_sudoku)
+
+        while len(history) < difficult_max:
+            if not position:
+                if not history:
+                    break
+                (row, col), value, position = history.pop()
+                checker.restore(row, col)
+                continue
+
+            position -= 1
+            row, col = variants[position]
+            if checker.remove(row, col):
+                history.append(((row, col), self.solved_sudoku[row][col], position))
+                if len(history) > maximum_difficult:
+                    maximum_difficult = len(history)
+                    maximum_history = history[:]
+
+            attempts += 1
+            if attempts > max_attempts_count:
+                break
+            if progress is not None and not attempts % CARVE_PROGRESS_ATTEMPTS:
+                if not progress(maximum_difficult, difficult_max, attempts):
+                    break
+            if deadline is not None and time.monotonic() > deadline:
+                break
+
+        if len(history) < maximum_difficult:
+            history = maximum_history
+        current_difficult = len(history)
+
+        # TODO
+        print('Max Target:', difficult_max, 'Max Founded:', maximum_difficult,
+              'Current:', current_difficult, 'Attempt', attempts)
+
+        return [cell for cell, value, position in history]
+
+    def _remove_cells(self, cells):
+        """Возвращает копию заполненной матрицы с очищенными клетками cells"""
+        problem_sudoku = self.get_solved_matrix()
+        for row, col in cells:
+            problem_sudoku[row][col] = 0
+        return problem_sudoku
+
+    def generate_sudoku(self, difficult_level_name, progress=None, deadline=None):
         """Генерирует и возвращает судоку определенного уровня сложности difficult,
         представленным в виде кортежа наименьшего и наибольшего возможного
-        количества оставшихся на поле клеток"""
+        количества оставшихся на поле клеток. progress и deadline передаются в carve"""
         if not self.constant:
             self.difficult_level_name = difficult_level_name
 
@@ -367,59 +1804,10 @@ class Sudoku:
             self.generate_initial_matrix()
             self.random_mix_matrix()
 
-            problem_sudoku = self.get_solved_matrix()
-
-            cells = self.size ** 4
-
             difficult_max, difficult_min = LEVELS_SETTINGS[difficult_level_name]
-            difficult_max = cells - difficult_max
-
-            variants = [(row, col, problem_sudoku[row][col]) for row in range(self.size ** 2)
-                        for col in range(self.size ** 2)]
-            random.shuffle(variants)
-
-            history = []
-
-            maximum_difficult = 0
-            maximum_sudoku = None
-
-            attempts = 0
-            max_attempts_count = ATTEMPTS_MAX_COUNT
-
-            current_difficult = 0
-            while current_difficult < difficult_max:
-                row, col, value = variants.pop()
-                problem_sudoku[row][col] = 0
-                solutions = 0
-                for _ in solve_sudoku((self.size, self.size), problem_sudoku):
-                    solutions += 1
-                if solutions == 1:
-                    current_difficult += 1
-                    if current_difficult > maximum_difficult:
-                        maximum_difficult = current_difficult
-                        # TODO
-                        # print('NEW MAXIMUM DIFFICULT', maximum_difficult)
-                        maximum_sudoku = copy.deepcopy(problem_sudoku)
-                    if variants:
-                        history.append(((row, col, value), copy.deepcopy(problem_sudoku),
-                                        copy.deepcopy(variants), current_difficult))
-                else:
-                    problem_sudoku[row][col] = value
+            difficult_max = self.size ** 4 - difficult_max
 
-                if not variants:
-                    deleted, problem_sudoku, variants, current_difficult = history.pop()
-                    row, col, value = deleted
-                    problem_sudoku[row][col] = value
-
-                attempts += 1
-                if attempts > max_attempts_count:
-                    problem_sudoku = copy.deepcopy(maximum_sudoku)
-                    current_difficult = maximum_difficult
-                    break
-
-            # TODO
-            print('Max Target:', difficult_max, 'Max Founded:', maximum_difficult,
-                  'Current:', current_difficult, 'Attempt', attempts)
+            problem_sudoku = self._remove_cells(self.carve(difficult_max, progress, deadline))
 
             self.problem_sudoku = problem_sudoku
             self.timestamp = datetime.datetime.timestamp(datetime.datetime.now())
@@ -428,6 +1816,59 @@ class Sudoku:
 
         return problem_sudoku
 
+    def generate_sudoku_levels(self, progress=None):
+        """Генерирует по судоку на каждый уровень из LEVELS_SETTINGS за один прогон
+        удаления клеток до самого сложного уровня; более легкие уровни получаются
+        из начала списка удаленных клеток. Возвращает словарь {уровень: Sudoku}; если
+        удаление остановилось раньше, уровень, который не убрал больше клеток, чем
+        предыдущий более легкий, в словарь не попадает. progress передается в carve"""
+        self.initialize_matrix()
+        self.generate_initial_matrix()
+        self.random_mix_matrix()
+
+        cells = self.size ** 4
+        targets = {level_name: max(cells - difficult_max, 0)
+                   for level_name, (difficult_max, difficult_min) in LEVELS_SETTINGS.items()}
+        removed = self.carve(max(targets.values()), progress)
+
+        timestamp = datetime.datetime.timestamp(datetime.datetime.now())
+        sudokus = {}
+        previous_count = -1
+        for level_name in sorted(targets, key=targets.get):
+            count = min(targets[level_name], len(removed))
+            if count <= previous_count:
+                continue
+            previous_count = count
+            sudokus[level_name] = Sudoku(self.size, level_name, timestamp,
+                                         self.get_solved_matrix(),
+                                         self._remove_cells(removed[:count]))
+        return sudokus
+
+    def get_isomorph(self, k=ISOMORPH_MIX_COUNT):
+        """Возвращает новый судоку, полученный из текущего k случайными допустимыми
+        преобразованиями; число подсказок и единственность решения сохраняются,
+        поэтому решатель не запускается"""
+        transform = self.random_transform(k)
+        isomorph = Sudoku(self.size, self.difficult_level_name,
+                          datetime.datetime.timestamp(datetime.datetime.now()),
+                          self.transform_matrix(self.solved_sudoku, transform),
+                          self.transform_matrix(self.problem_sudoku, transform))
+        isomorph.sudoku_hash = self.get_canonical_hash()
+        isomorph.isomorph = True
+        return isomorph
+
+    def generate_isomorphs(self, count, k=ISOMORPH_MIX_COUNT):
+        """Генератор count случайных изоморфов текущего судоку"""
+        for _ in range(count):
+            yield self.get_isomorph(k)
+
+    def get_canonical_hash(self):
+        """Хеш канонической формы нерешенной матрицы: одинаков у всех судоку,
+        переходящих друг в друга допустимыми преобразованиями"""
+        if self.sudoku_hash is None:
+            self.sudoku_hash = canonical_hash(self.size, self.problem_sudoku)
+        return self.sudoku_hash
+
     def get_solved_matrix(self):
         """Возвращает копию текущей заполненной матрицы"""
         return copy.deepcopy(self.solved_sudoku)
@@ -452,6 +1893,10 @@ class LeadersBoard(QWidget):
         super(LeadersBoard, self).__init__()
         self.setupUi(self)
         self.parent_window = parent_window
+        self.show_same.setCheckable(True)
+        self.show_same.toggled.connect(self.fill_table)
+        self.selecter_difficult_level.currentIndexChanged.connect(self.fill_table)
+        self.fill_table()
 
     def setupUi(self, Form):
         Form.setObjectName("Form")
@@ -474,10 +1919,8 @@ class LeadersBoard(QWidget):
         self.selecter_difficult_level.addItem("")
         self.horizontalLayout.addWidget(self.selecter_difficult_level)
         self.verticalLayout.addLayout(self.horizontalLayout)
-        self.table = QtWidgets.QTableWidget(Form)
+        self.table = QtWidgets.QTableView(Form)
         self.table.setObjectName("table")
-        self.table.setColumnCount(0)
-        self.table.setRowCount(0)
         self.table.verticalHeader().setVisible(False)
         self.verticalLayout.addWidget(self.table)
 
@@ -495,17 +1938,278 @@ class LeadersBoard(QWidget):
         self.selecter_difficult_level.setItemText(2, _translate("Form", "Средне 👦"))
         self.selecter_difficult_level.setItemText(3, _translate("Form", "Сложно 🤓"))
 
+    def update_show_same(self):
+        """Режим show_same доступен, только если матрица главного окна уже есть в базе:
+        у новой сгенерированной матрицы id появляется после ее записи"""
+        has_matrix = self.parent_window.sudoku.matrix_id is not None
+        self.show_same.setEnabled(has_matrix)
+        if has_matrix:
+            self.show_same.setToolTip('')
+        else:
+            self.show_same.blockSignals(True)
+            self.show_same.setChecked(False)
+            self.show_same.blockSignals(False)
+            self.show_same.setToolTip('Текущее судоку еще не сохранено в базе')
+
     def get_results(self):
-        level = self.selecter_difficult_level.currentText()
-        if level == 'Сложность':
-            level = '%%'
+        """Модель результатов для выбранного уровня или, в режиме show_same,
+        для текущей матрицы главного окна"""
+        self.update_show_same()
+        level = LEVEL_NAMES.get(self.selecter_difficult_level.currentText())
+        matrix_id = self.parent_window.sudoku.matrix_id if self.show_same.isChecked() else None
+        return LeadersModel(self.parent_window.database_cursor, level, matrix_id)
 
+    def fill_table(self):
+        results = self.get_results()
+        self.table.setModel(results)
 
+    def showEvent(self, event):
+        # Пока окно было скрыто, матрица могла записаться в базу
+        self.update_show_same()
+        super(LeadersBoard, self).showEvent(event)
 
-        result = self.parent_window.database_cursor.get_data()
 
-    def fill_table(self):
-        results = self.get_results()
+class LeadersModel(QtCore.QAbstractTableModel):
+    """Таблица рекордов, которая подгружает строки из базы страницами
+    по LEADERS_PAGE_SIZE по мере прокрутки"""
+
+    def __init__(self, database_cursor, level=None, matrix_id=None):
+        super(LeadersModel, self).__init__()
+        self.database_cursor = database_cursor
+        self.level = level
+        self.matrix_id = matrix_id
+        if matrix_id is None:
+            self.headers = ('Место', 'Игрок', 'Уровень', 'Лучшее время', 'Попыток')
+        else:
+            self.headers = ('Место', 'Игрок', 'Уровень', 'Время', 'Дата')
+        self.results = []
+        self.has_more = True
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.results)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if role != QtCore.Qt.DisplayRole or not index.isValid():
+            return None
+        value = self.results[index.row()][index.column()]
+        if index.column() == 3:
+            return format_time(value)
+        return str(value)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
+            return self.headers[section]
+        return None
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        return not parent.isValid() and self.has_more
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        page = self.database_cursor.get_data(level=self.level, matrix_id=self.matrix_id,
+                                             limit=LEADERS_PAGE_SIZE, offset=len(self.results))
+        self.has_more = len(page) == LEADERS_PAGE_SIZE
+        if page:
+            self.beginInsertRows(QtCore.QModelIndex(), len(self.results),
+                                 len(self.results) + len(page) - 1)
+            self.results += page
+            self.endInsertRows()
+
+
+class GenerationSignals(QtCore.QObject):
+    progress = QtCore.pyqtSignal(int, int, int)
+    finished = QtCore.pyqtSignal(object)
+
+
+class GenerationTask(QtCore.QRunnable):
+    """Генерация судоку для новой игры в пуле потоков Qt. Ход удаления клеток
+    приходит сигналом progress(удалено, цель, попытки), готовый судоку - сигналом
+    finished. Через timeout секунд берется лучший найденный судоку;
+    после cancel генерация останавливается, и finished не посылается"""
+
+    def __init__(self, size, level_name, timeout=GAME_GENERATION_TIMEOUT):
+        super(GenerationTask, self).__init__()
+        self.size = size
+        self.level_name = level_name
+        self.timeout = timeout
+        self.signals = GenerationSignals()
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def report(self, removed, target, attempts):
+        self.signals.progress.emit(removed, target, attempts)
+        return not self.cancelled
+
+    def run(self):
+        sudoku = Sudoku(self.size)
+        sudoku.generate_sudoku(self.level_name, progress=self.report,
+                               deadline=time.monotonic() + self.timeout)
+        if not self.cancelled:
+            # Хеш понадобится при сохранении судоку; в потоке интерфейса его не считаем
+            sudoku.get_canonical_hash()
+            self.signals.finished.emit(sudoku)
+
+
+class BoardWidget(QWidget):
+    """Поле судоку, которое целиком рисуется в paintEvent по плоскому массиву клеток.
+    Клетка с номером cell стоит в строке cell // side и столбце cell % side"""
+
+    cellClicked = QtCore.pyqtSignal(int, int)
+
+    GIVEN_COLOR = QtGui.QColor(0, 0, 0)
+    ENTRY_COLOR = QtGui.QColor(30, 80, 200)
+    BACKGROUND_COLOR = QtGui.QColor(255, 255, 255)
+    GIVEN_BACKGROUND_COLOR = QtGui.QColor(235, 235, 235)
+    SELECTED_COLOR = QtGui.QColor(190, 215, 255)
+    LINE_COLOR = QtGui.QColor(150, 150, 150)
+    BOX_LINE_COLOR = QtGui.QColor(0, 0, 0)
+    CONFLICT_COLOR = QtGui.QColor(210, 0, 0)
+
+    def __init__(self, size=3, parent=None):
+        super(BoardWidget, self).__init__(parent)
+        self.size = size
+        self.side = size ** 2
+        self.values = [0] * self.side ** 2
+        self.givens = [False] * self.side ** 2
+        # Выведенные отметки конфликтов; сами конфликты считает BoardState
+        self.conflicts = [False] * self.side ** 2
+        self.state = None
+        self.selected = None
+        # Положение поля в виджете; пересчитывается в resizeEvent
+        self.cell_size = 1
+        self.left = 0
+        self.top = 0
+        self.given_font = QtGui.QFont()
+        self.given_font.setBold(True)
+        self.entry_font = QtGui.QFont()
+        self.setMinimumSize(self.side * BOARD_MIN_CELL_SIZE, self.side * BOARD_MIN_CELL_SIZE)
+        self.setSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Expanding)
+
+    def load(self, matrix, problem, state=None):
+        """Выводит доску matrix; клетки, заполненные в условии problem, не выбираются.
+        По state (BoardState этой доски) отмечаются конфликты.
+        Перерисовываются только клетки, которые отличаются от выведенных"""
+        values = [value for row in matrix for value in row]
+        givens = [bool(value) for row in problem for value in row]
+        self.state = state
+        changed = QtGui.QRegion()
+        for cell, (value, given) in enumerate(zip(values, givens)):
+            conflict = state is not None and state.is_conflict(cell)
+            if value != self.values[cell] or given != self.givens[cell] or \
+                    conflict != self.conflicts[cell]:
+                changed += self.cell_rect(cell)
+        if self.selected is not None:
+            changed += self.cell_rect(self.selected)
+        self.values = values
+        self.givens = givens
+        self.selected = None
+        # Все изменения уходят в одну перерисовку
+        if not changed.isEmpty():
+            self.update(changed)
+
+    def set_value(self, row, col, value):
+        """Выводит число в клетку; отметки конфликтов могут измениться
+        только в ее строке, столбце и блоке, поэтому перерисовываются они"""
+        cell = row * self.side + col
+        if self.values[cell] != value:
+            self.values[cell] = value
+            self.update(self.units_region(row, col))
+
+    def units_region(self, row, col) -> QtGui.QRegion:
+        """Область строки, столбца и блока клетки"""
+        length = self.side * self.cell_size
+        box_length = self.size * self.cell_size
+        region = QtGui.QRegion(self.left, self.top + row * self.cell_size,
+                               length, self.cell_size)
+        region += QtCore.QRect(self.left + col * self.cell_size, self.top,
+                               self.cell_size, length)
+        region += QtCore.QRect(self.left + col // self.size * box_length,
+                               self.top + row // self.size * box_length,
+                               box_length, box_length)
+        return region
+
+    def select(self, row, col):
+        if self.selected is not None:
+            self.update(self.cell_rect(self.selected))
+        self.selected = row * self.side + col
+        self.update(self.cell_rect(self.selected))
+
+    def cell_rect(self, cell) -> QtCore.QRect:
+        return QtCore.QRect(self.left + cell % self.side * self.cell_size,
+                            self.top + cell // self.side * self.cell_size,
+                            self.cell_size, self.cell_size)
+
+    def cell_at(self, x, y):
+        """Номер клетки под точкой (x, y) или None"""
+        col = (x - self.left) // self.cell_size
+        row = (y - self.top) // self.cell_size
+        if 0 <= row < self.side and 0 <= col < self.side:
+            return row * self.side + col
+        return None
+
+    def resizeEvent(self, event: QtGui.QResizeEvent) -> None:
+        self.cell_size = max(min(self.width(), self.height()) // self.side, 1)
+        self.left = (self.width() - self.cell_size * self.side) // 2
+        self.top = (self.height() - self.cell_size * self.side) // 2
+        # Двузначные числа должны помещаться в клетку
+        pixel_size = max(self.cell_size * (6 if self.side < 10 else 4) // 10, 1)
+        self.given_font.setPixelSize(pixel_size)
+        self.entry_font.setPixelSize(pixel_size)
+
+    def mousePressEvent(self, event: QtGui.QMouseEvent) -> None:
+        cell = self.cell_at(event.x(), event.y())
+        if cell is None or self.givens[cell]:
+            return
+        self.select(cell // self.side, cell % self.side)
+        self.cellClicked.emit(cell // self.side, cell % self.side)
+
+    def paintEvent(self, event: QtGui.QPaintEvent) -> None:
+        painter = QtGui.QPainter(self)
+        side = self.side
+        rect = event.rect()
+        # Перерисовываются только клетки, попавшие в обновляемую область
+        first_col = max((rect.left() - self.left) // self.cell_size, 0)
+        last_col = min((rect.right() - self.left) // self.cell_size, side - 1)
+        first_row = max((rect.top() - self.top) // self.cell_size, 0)
+        last_row = min((rect.bottom() - self.top) // self.cell_size, side - 1)
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                cell = row * side + col
+                cell_rect = self.cell_rect(cell)
+                if cell == self.selected:
+                    painter.fillRect(cell_rect, self.SELECTED_COLOR)
+                elif self.givens[cell]:
+                    painter.fillRect(cell_rect, self.GIVEN_BACKGROUND_COLOR)
+                else:
+                    painter.fillRect(cell_rect, self.BACKGROUND_COLOR)
+                self.conflicts[cell] = self.state is not None and self.state.is_conflict(cell)
+                if self.values[cell]:
+                    if self.conflicts[cell]:
+                        painter.setFont(self.given_font if self.givens[cell] else self.entry_font)
+                        painter.setPen(self.CONFLICT_COLOR)
+                    elif self.givens[cell]:
+                        painter.setFont(self.given_font)
+                        painter.setPen(self.GIVEN_COLOR)
+                    else:
+                        painter.setFont(self.entry_font)
+                        painter.setPen(self.ENTRY_COLOR)
+                    painter.drawText(cell_rect, QtCore.Qt.AlignCenter, str(self.values[cell]))
+
+        right = self.left + side * self.cell_size
+        bottom = self.top + side * self.cell_size
+        for i in range(side + 1):
+            if i % self.size:
+                painter.setPen(QtGui.QPen(self.LINE_COLOR, 1))
+            else:
+                painter.setPen(QtGui.QPen(self.BOX_LINE_COLOR, 2))
+            x = self.left + i * self.cell_size
+            y = self.top + i * self.cell_size
+            painter.drawLine(x, self.top, x, bottom)
+            painter.drawLine(self.left, y, right, y)
 
 
 class Ui_MainWindow(object):
@@ -541,10 +2245,17 @@ class Ui_MainWindow(object):
         self.action_9.setObjectName("action_9")
         self.action_11 = QtWidgets.QAction(MainWindow)
         self.action_11.setObjectName("action_10")
+        self.action_12 = QtWidgets.QAction(MainWindow)
+        self.action_12.setObjectName("action_12")
+        self.action_13 = QtWidgets.QAction(MainWindow)
+        self.action_13.setObjectName("action_13")
+        self.action_13.setShortcut("Ctrl+H")
         self.menu_2.addAction(self.action_7)
         self.menu_2.addAction(self.action_8)
         self.menu_2.addAction(self.action_9)
         self.menu.addAction(self.menu_2.menuAction())
+        self.menu.addAction(self.action_12)
+        self.menu.addAction(self.action_13)
         self.menu.addSeparator()
         self.menu.addAction(self.action_5)
         self.menu.addAction(self.action_2)
@@ -569,6 +2280,8 @@ class Ui_MainWindow(object):
         self.action_8.setText(_translate("MainWindow", "Средне 👦"))
         self.action_9.setText(_translate("MainWindow", "Сложно 🤓"))
         self.action_11.setText(_translate("MainWindow", "Спрятать таймер"))
+        self.action_12.setText(_translate("MainWindow", "Продолжить"))
+        self.action_13.setText(_translate("MainWindow", "Подсказка"))
 
 
 class MainWindow(Ui_MainWindow, QMainWindow):
@@ -578,9 +2291,18 @@ class MainWindow(Ui_MainWindow, QMainWindow):
         self.sudoku_size = sudoku_size
         self.sudoku = Sudoku(self.sudoku_size)
         self.game_state = EMPTY
+        # Доска с ходами игрока и выбранная клетка (строка, столбец)
+        self.player_matrix = None
+        self.board_state = None
+        self.hint_engine = None
+        self.selected_cell = None
+        # Клетка, в которую только что введена цифра
+        self.typed_cell = None
 
         self.action_11.triggered.connect(self.show_hide_timer)
         self.action_2.triggered.connect(self.show_records_table)
+        self.action_12.triggered.connect(self.continue_game)
+        self.action_13.triggered.connect(self.show_hint)
 
         self.database_cursor = None
         self.connect_db()
@@ -598,68 +2320,203 @@ class MainWindow(Ui_MainWindow, QMainWindow):
             getattr(self, name).triggered.connect(self.new_game_btn_clicked)
 
         self.main_layout = QtWidgets.QGridLayout(self.centralwidget)
-        self.main_layout.setHorizontalSpacing(3)
-        self.main_layout.setVerticalSpacing(3)
-
-        sizePolicy = QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Expanding,
-                                           QtWidgets.QSizePolicy.Expanding)
-        sizePolicy.setHorizontalStretch(0)
-        sizePolicy.setVerticalStretch(0)
-
-        for i in range(self.sudoku_size):
-            for j in range(self.sudoku_size):
-                name = 'layout%i%d' % (i, j)
-                setattr(self, name, QtWidgets.QGridLayout())
-                getattr(self, name).setHorizontalSpacing(1)
-                getattr(self, name).setVerticalSpacing(1)
-                self.main_layout.addLayout(getattr(self, name), i, j)
-
-        for i in range(self.sudoku_size ** 2):
-            for j in range(self.sudoku_size ** 2):
-                name = f'layout{i // self.sudoku_size}{j // self.sudoku_size}'
-                setattr(self, f'btn{i}{j}', QPushButton())
-                getattr(self, name).addWidget(getattr(self, f'btn{i}{j}'), i % self.sudoku_size,
-                                              j % self.sudoku_size, 1, 1)
-                getattr(self, f'btn{i}{j}').setSizePolicy(sizePolicy)
-                getattr(self, f'btn{i}{j}').setMinimumSize(QtCore.QSize(30, 30))
-                my_font = QtGui.QFont()
-                my_font.setPixelSize(20)
-                getattr(self, f'btn{i}{j}').setFont(my_font)
-
-        for key in LEVELS_SETTINGS:
-            thread = MyThread('HARD')
-            thread.start()
+        self.board = BoardWidget(self.sudoku_size)
+        self.board.cellClicked.connect(self.select_cell)
+        self.main_layout.addWidget(self.board, 0, 0)
+
+        self.autosave = GameAutosave(DB_NAME)
+        self.autosave_timer = QTimer(self)
+        self.autosave_timer.setSingleShot(True)
+        self.autosave_timer.setInterval(GAME_AUTOSAVE_DELAY)
+        self.autosave_timer.timeout.connect(self.autosave_game)
+
+        self.generation_pool = GenerationPool()
+        self.bank = SudokuBank(self.database_cursor, self.generation_pool,
+                               sizes=(self.sudoku_size,))
+        self.hint_label = QtWidgets.QLabel()
+        self.statusbar.addPermanentWidget(self.hint_label)
+
+        self.generation_task = None
+        self.generation_progress = QtWidgets.QProgressBar()
+        self.generation_progress.setMaximumWidth(200)
+        self.cancel_generation_btn = QtWidgets.QPushButton('Отмена')
+        self.cancel_generation_btn.clicked.connect(self.cancel_generation)
+        self.statusbar.addPermanentWidget(self.generation_progress)
+        self.statusbar.addPermanentWidget(self.cancel_generation_btn)
+        self.generation_progress.hide()
+        self.cancel_generation_btn.hide()
+
+        self.bank_timer = QTimer(self)
+        self.bank_timer.timeout.connect(self.refill_bank)
+        self.bank_timer.start(BANK_CHECK_INTERVAL)
+        self.refill_bank()
 
     def load_matrix(self, matrix=None):
+        problem = self.sudoku.problem_sudoku
         if matrix is None:
-            matrix = self.sudoku.get_problem_matrix()
-        for i in range(len(matrix)):
-            for j in range(len(matrix)):
-                getattr(self, f'btn{i}{j}').setDisabled(False)
-                getattr(self, f'btn{i}{j}').setText(str(matrix[i][j]) if matrix[i][j] else ' ')
-                if getattr(self, f'btn{i}{j}').text() != ' ':
-                    getattr(self, f'btn{i}{j}').setDisabled(True)
+            matrix = problem
+        self.board.load(matrix, problem, self.board_state)
+
+    def start_game(self, sudoku, matrix=None, game_seconds=0, game_id=None):
+        """Выводит игру sudoku с доской matrix (по умолчанию - условие) и начинает
+        ее автосохранение; game_id задается, когда игра продолжается из базы"""
+        self.autosave_game()
+        self.sudoku = sudoku
+        if matrix is None:
+            matrix = sudoku.get_problem_matrix()
+        self.player_matrix = matrix
+        self.board_state = BoardState(self.sudoku_size, sudoku.problem_sudoku, matrix)
+        self.hint_engine = HintEngine(self.board_state)
+        self.hint_label.clear()
+        self.selected_cell = None
+        self.typed_cell = None
+        self.load_matrix(matrix)
+        self.game_seconds = game_seconds
+        self.game_state = IN_GAME
+        self.autosave.start(sudoku, matrix, game_seconds, game_id)
+
+    def continue_game(self):
+        """Продолжает последнюю незаконченную игру, восстанавливая ее из журнала ходов"""
+        self.autosave_game()
+        get_writer(DB_NAME).wait()
+        saved_game = self.database_cursor.get_saved_game(self.sudoku_size, self.autosave.game_id)
+        if saved_game is None:
+            self.statusbar.showMessage('Нет незаконченных игр')
+            return
+        game_id, sudoku, matrix, game_seconds = saved_game
+        self.start_game(sudoku, matrix, game_seconds, game_id)
+
+    def select_cell(self, row, col):
+        self.selected_cell = (row, col)
+        self.typed_cell = None
+
+    def set_cell(self, row, col, value):
+        """Ход игрока: число value (0 - стереть) в клетку; условие не меняется"""
+        cell = row * len(self.player_matrix) + col
+        if self.game_state != IN_GAME or self.board_state.givens[cell]:
+            return
+        if self.player_matrix[row][col] == value:
+            return
+        self.hint_engine.moved(cell, self.player_matrix[row][col])
+        self.player_matrix[row][col] = value
+        self.board_state.set(cell, value)
+        self.board.set_value(row, col, value)
+        self.autosave.record(cell, value)
+        if self.board_state.is_solved():
+            self.finish_game()
+        else:
+            # Сохранение откладывается, пока игрок вводит числа подряд
+            self.autosave_timer.start()
+
+    def show_hint(self):
+        """Ставит число в клетку, которая следует из текущей доски, и объясняет почему"""
+        if self.game_state != IN_GAME:
+            return
+        hint = self.hint_engine.hint()
+        if hint is None:
+            if self.board_state.duplicates:
+                self.hint_label.setText('Сначала исправьте ошибки на доске')
+            else:
+                self.hint_label.setText('Подсказки нет')
+            return
+        cell, value, reason = hint
+        row, col = divmod(cell, len(self.player_matrix))
+        self.hint_label.setText(reason)
+        self.board.select(row, col)
+        self.select_cell(row, col)
+        self.set_cell(row, col, value)
+
+    def finish_game(self):
+        """Судоку решено: таймер останавливается, результат записывается в рекорды"""
+        self.game_state = GAME_SOLVED
+        self.autosave_timer.stop()
+        self.autosave.finish('SOLVED')
+        name, ok = QtWidgets.QInputDialog.getText(
+            self, 'Судоку решено', f'Время: {format_time(self.game_seconds)}. Ваше имя:')
+        if not ok or not name:
+            return
+        get_writer(DB_NAME).insert_record(name, self.sudoku, self.game_seconds)
+
+    def autosave_game(self):
+        self.autosave_timer.stop()
+        if self.game_state != EMPTY:
+            self.autosave.flush(self.player_matrix, self.game_seconds)
+
+    def keyPressEvent(self, event: QtGui.QKeyEvent) -> None:
+        if self.selected_cell is not None:
+            if QtCore.Qt.Key_0 <= event.key() <= QtCore.Qt.Key_9:
+                row, col = self.selected_cell
+                value = event.key() - QtCore.Qt.Key_0
+                # На досках больше 9 на 9 число можно набрать из двух цифр подряд
+                if self.typed_cell == self.selected_cell and \
+                        self.player_matrix[row][col] * 10 + value <= self.sudoku_size ** 2:
+                    value += self.player_matrix[row][col] * 10
+                if 0 < value <= self.sudoku_size ** 2:
+                    self.set_cell(row, col, value)
+                    self.typed_cell = self.selected_cell
+                return
+            if event.key() in (QtCore.Qt.Key_Backspace, QtCore.Qt.Key_Delete):
+                self.set_cell(*self.selected_cell, 0)
+                self.typed_cell = None
+                return
+        super(MainWindow, self).keyPressEvent(event)
 
     def new_game_btn_clicked(self):
         self.check_save()
         btn = self.sender()
-        levels = {
-            "Легко 👶": 'EASY',
-            "Средне 👦": 'STANDARD',
-            "Сложно 🤓": 'HARD'
-        }
-        level = levels[btn.text()]
+        level = LEVEL_NAMES[btn.text()]
         print(level)
-        self.sudoku.generate_sudoku(level)
-        self.load_matrix()
-        self.reset_time()
-        self.game_state = IN_GAME
+        sudoku = self.database_cursor.get_sudoku_from_db(level, self.sudoku_size)
+        if sudoku is None:
+            self.start_generation(level)
+        else:
+            self.stop_generation()
+            self.start_game(sudoku)
+
+    def start_generation(self, level):
+        """Запускает генерацию новой игры в фоне; игра начнется по сигналу finished"""
+        self.stop_generation()
+        task = GenerationTask(self.sudoku_size, level)
+        task.signals.progress.connect(self.show_generation_progress)
+        task.signals.finished.connect(self.generation_finished)
+        self.generation_task = task
+        self.generation_progress.setRange(0, 0)
+        self.generation_progress.show()
+        self.cancel_generation_btn.show()
+        QtCore.QThreadPool.globalInstance().start(task)
+
+    def show_generation_progress(self, removed, target, attempts):
+        self.generation_progress.setRange(0, target)
+        self.generation_progress.setValue(removed)
+        self.generation_progress.setFormat(f'%v из %m, попыток: {attempts}')
+
+    def generation_finished(self, sudoku):
+        # Сигнал от отмененной генерации мог прийти уже после отмены
+        if self.generation_task is None or self.sender() is not self.generation_task.signals:
+            return
+        self.stop_generation()
+        self.start_game(sudoku)
+
+    def stop_generation(self):
+        if self.generation_task is not None:
+            self.generation_task.cancel()
+            self.generation_task = None
+        self.generation_progress.hide()
+        self.cancel_generation_btn.hide()
+
+    def cancel_generation(self):
+        """Отменяет генерацию новой игры; прежняя игра продолжается"""
+        self.stop_generation()
+        if self.game_state == PAUSE:
+            self.game_state = IN_GAME
 
     def save_game(self):
-        try:
-            self.database_cursor.insert_sudoku_into_db(self.sudoku)
-        except Exception as e:
-            print(e)
+        writer = get_writer(DB_NAME)
+        if self.sudoku.matrix_id is not None:
+            writer.execute("UPDATE matrixes SET status = 'SAVED' WHERE id = ?",
+                           (self.sudoku.matrix_id,))
+        elif self.sudoku.problem_sudoku:
+            writer.insert_sudokus([self.sudoku], status='SAVED')
 
     def reset_time(self):
         self.game_seconds = 0
@@ -668,11 +2525,7 @@ class MainWindow(Ui_MainWindow, QMainWindow):
         if self.game_state == IN_GAME:
             self.game_seconds += 1
         if self.is_show_timer:
-            hours = self.game_seconds // 3600
-            minutes = self.game_seconds // 60 % 60
-            seconds = self.game_seconds % 60
-            self.statusbar.showMessage((str(hours) + ':' if hours else '') + f'{minutes}' +
-                                       ':' + f'{seconds}'.rjust(2, '0'))
+            self.statusbar.showMessage(format_time(self.game_seconds))
 
     def show_hide_timer(self):
         self.is_show_timer = not self.is_show_timer
@@ -686,10 +2539,15 @@ class MainWindow(Ui_MainWindow, QMainWindow):
 
     def closeEvent(self, a0: QtGui.QCloseEvent) -> None:
         self.check_save()
+        self.autosave_game()
+        self.stop_generation()
+        QtCore.QThreadPool.globalInstance().waitForDone(PROGRAM_SECOND)
+        self.generation_pool.shutdown()
+        close_writer(DB_NAME)
         self.database_cursor.terminate()
 
     def check_save(self):
-        if self.game_state != EMPTY:
+        if self.game_state in (IN_GAME, PAUSE):
             self.game_state = PAUSE
             message_box = QtWidgets.QMessageBox
             answer = message_box.question(self, '',
@@ -699,12 +2557,15 @@ class MainWindow(Ui_MainWindow, QMainWindow):
                 self.save_game()
 
     def generate_new_sudokus(self, level):
-        if level is str:
+        if isinstance(level, str):
             MyThread(level).start()
-        elif level is list:
+        elif isinstance(level, list):
             for key in level:
                 MyThread(key).start()
 
+    def refill_bank(self):
+        self.bank.refill(game_active=self.game_state == IN_GAME)
+
     def show_records_table(self):
         self.new_window = LeadersBoard(self)
         self.new_window.show()